@@ -234,8 +234,7 @@ class DownloadGPWV4Data(QgsProcessingAlgorithm):
         if mask_path is None:
             dataset_dl.download(dataset, year, country=None, file_path=output)
         else:
-            dataset_dl.download(dataset, year, country=None, file_path=output)
-            dataset_dl.mask(mask_path)
+            dataset_dl.download(dataset, year, country=None, file_path=output, mask=mask_path)
 
         return {self.OUTPUT: output}
 
@@ -303,7 +302,7 @@ class GridCellClassification(QgsProcessingAlgorithm):
 
         degurba = DEGURBA(raster_path)
         grid_cells_l1 = degurba.classify_grid_cells_l1()
-        grid_cells_l1.save(output, nodata=0)
+        grid_cells_l1.save(output, nodata=0, profile='cog')
 
         return {self.OUTPUT: output}
 
@@ -317,7 +316,8 @@ class GridCellClassification(QgsProcessingAlgorithm):
 class LocalUnitsClassification(QgsProcessingAlgorithm):
     INPUT = 'GRIDCELL'
     FIELD = 'FIELD'
-    OUTPUT = 'LOCAL UNITS VECTOR'
+    LOCAL_UNITS = 'LOCAL UNITS VECTOR'
+    OUTPUT = 'OUTPUT'
 
     def __init__(self):
         super().__init__()
@@ -359,6 +359,12 @@ class LocalUnitsClassification(QgsProcessingAlgorithm):
                                                        defaultValue='l1'))
         self.addParameter(
             QgsProcessingParameterFeatureSource(
+                self.LOCAL_UNITS,
+                self.tr('Local Units Layer'),
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorDestination(
                 self.OUTPUT,
                 self.tr('Output Layer'),
             )
@@ -370,10 +376,11 @@ class LocalUnitsClassification(QgsProcessingAlgorithm):
 
         field = self.parameterAsString(parameters, self.FIELD, context)
 
-        vector_layer = self.parameterAsVectorLayer(parameters, self.OUTPUT, context)
+        vector_layer = self.parameterAsVectorLayer(parameters, self.LOCAL_UNITS, context)
         vector_path = vector_layer.dataProvider().dataSourceUri()
+        output = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
 
-        log = '\n   %s \n   %s \n   %s \n' % (vector_path, raster_path, field)
+        log = '\n   %s \n   %s \n   %s \n   %s \n' % (vector_path, raster_path, field, output)
         print(log)
         QgsMessageLog.logMessage(log)
 
@@ -381,11 +388,10 @@ class LocalUnitsClassification(QgsProcessingAlgorithm):
         local_units = degurba.classify_local_units_l1(vector_path,
                                                       grid_cells_l1=raster_path,
                                                       field=field,
-                                                      all_touched=False)
+                                                      all_touched=False,
+                                                      out_path=output)
 
-        vector_layer.reload()
-
-        return {self.OUTPUT: vector_path}
+        return {self.OUTPUT: output}
 
     def createInstance(self):
         return LocalUnitsClassification()
@@ -0,0 +1,70 @@
+"""Benchmark of the windows of io.boundless_array (user-009).
+
+Windows inside the raster are views of the array and of its mask, the
+previous implementation padded every window into a new masked array. The
+peak allocation is measured with tracemalloc for windows the size of a
+zone of read_from_geometry.
+
+    python benchmarks/bench_boundless_array.py [zones]
+"""
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from degurba.io import boundless_array, overlap
+
+
+def padded_array(arr, window):
+    """The previous boundless_array of a 2D array: every window is copied"""
+    (wr_start, wr_stop), (wc_start, wc_stop) = window
+    (olr_start, olr_stop), (olc_start, olc_stop) = overlap(arr.shape, window)
+    out = np.ma.MaskedArray(
+        np.zeros(shape=(wr_stop - wr_start, wc_stop - wc_start), dtype=arr.dtype),
+        mask=True)
+    nr_start, nc_start = olr_start - wr_start, olc_start - wc_start
+    out[nr_start:nr_start + olr_stop - olr_start, nc_start:nc_start + olc_stop - olc_start] = \
+        arr[olr_start:olr_stop, olc_start:olc_stop]
+    return out
+
+
+def measure(func, arr, windows):
+    tracemalloc.start()
+    peaks = []
+    for window in windows:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        out = func(arr, window)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        del out
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for window in windows:
+        func(arr, window)
+    elapsed = (time.perf_counter() - start) / len(windows)
+    return np.mean(peaks), elapsed
+
+
+def main(zones=300):
+    rng = np.random.default_rng(0)
+    arr = np.ma.masked_array(rng.random((2000, 2000)).astype(np.float32),
+                             mask=rng.random((2000, 2000)) < 0.1)
+    rows = rng.integers(0, 1900, zones)
+    cols = rng.integers(0, 1900, zones)
+    windows = [((r, r + 40), (c, c + 45)) for r, c in zip(rows, cols)]
+    for i, window in enumerate(windows):
+        assert np.ma.allequal(boundless_array(arr, window), padded_array(arr, window))
+
+    print('{} in-extent windows of 40x45 cells'.format(zones))
+    for name, func in (('views (boundless_array)', boundless_array),
+                       ('padded copies (previous)', padded_array)):
+        peak, elapsed = measure(func, arr, windows)
+        print('{:<26} {:7.1f} KB peak per zone, {:6.1f} us per window'.format(
+            name, peak / 1024, elapsed * 1e6))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""Benchmark of the population threshold of the clusters (user-001).
+
+The totals of all the clusters come from one labeled reduction
+(cluster.cluster_sums and keep_clusters), the previous implementation built
+a full-raster label == i mask for every cluster. The old loop is timed on a
+few clusters and extrapolated to all of them, it would take days on the
+full grid.
+
+    python benchmarks/bench_cluster_sums.py [size] [sampled clusters]
+"""
+import os
+import sys
+import time
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from degurba.cluster import cluster_sums, keep_clusters
+
+
+def old_keep(mask, label, pn, threshold, clusters):
+    """The per-cluster loop of the previous implementation, on the first clusters"""
+    for i in clusters:
+        cluster = label == i
+        if np.sum(pn[cluster]) < threshold:
+            mask[cluster] = 0
+    return mask
+
+
+def main(size=10000, sample=5):
+    rng = np.random.default_rng(0)
+    pn = np.ma.masked_array(rng.random((size, size), dtype=np.float32) ** 3 * 1500)
+    mask = (pn >= 300).data.astype(np.byte)
+    label, num_features = ndimage.label(mask, structure=np.ones((3, 3)))
+    print('grid {0}x{0}, {1} clusters'.format(size, num_features))
+
+    start = time.perf_counter()
+    sums, counts = cluster_sums(label, num_features, pn)
+    keep = keep_clusters(sums, counts, 5000)
+    keep[label].astype(np.byte)
+    new = time.perf_counter() - start
+
+    start = time.perf_counter()
+    old_keep(mask.copy(), label, pn, 5000, range(1, sample + 1))
+    old = (time.perf_counter() - start) / sample
+
+    print('labeled reduction: {:.2f} s'.format(new))
+    print('per-cluster loop:  {:.3f} s per cluster, about {:.0f} s for all of them'.format(
+        old, old * num_features))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
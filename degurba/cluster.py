@@ -0,0 +1,122 @@
+import numpy as np
+from scipy import ndimage
+
+
+def cluster_sums(label, num_features, pn):
+    """Sum the population of every labeled cluster in a single pass.
+        Args:
+            label (numpy array): cluster labels, 0 is the background.
+            num_features (int): number of clusters in label.
+            pn (numpy array): population counts array, masked cells are ignored.
+        Returns:
+            sums (numpy array): total population of each label, index 0 is the background.
+            counts (numpy array): number of unmasked cells of each label.
+    """
+    valid = ~np.ma.getmaskarray(pn)
+    values = np.where(valid, np.ma.getdata(pn), 0)
+    sums = np.bincount(label.ravel(), weights=values.ravel(),
+                       minlength=num_features+1)
+    counts = np.bincount(label.ravel(), weights=valid.ravel(),
+                         minlength=num_features+1)
+    return sums, counts
+
+
+def keep_clusters(sums, counts, threshold):
+    """Build a lookup table of the clusters whose total population reaches threshold.
+        Args:
+            sums (numpy array): result of cluster_sums.
+            counts (numpy array): result of cluster_sums.
+            threshold (int or float): minimum population of a cluster.
+        Returns:
+            numpy bool array indexed by label, index 0 (background) is always False.
+    """
+    # A cluster made only of masked cells has a masked sum, which never
+    # compares as smaller than the threshold, so it is kept.
+    keep = np.logical_or(~(sums < threshold), counts == 0)
+    keep[0] = False
+    return keep
+
+
+def majority_fill(mask, label, majority=5, max_rounds=None):
+    """Fill gaps and smooth borders with the iterative 'majority rule', in place.
+        The cells that have at least `majority` of their eight neighbours in
+        one cluster are set to 1 in mask, then the same rule is applied to
+        the cells that flipped in the previous round until nothing changes.
+        All the clusters advance together: every round is one majority_label
+        over the bounding box of the current frontier, so the work does not
+        grow with the number of clusters.
+        Args:
+            mask (numpy array): cluster mask, updated in place.
+            label (numpy array): cluster labels, 0 is the background.
+            majority (int): minimum number of neighbours in the frontier, more than 4.
+            max_rounds (int): maximum number of rounds, None runs until nothing
+                changes. One round is keep[label] | majority_rule(np.pad(label, 1)).
+        Returns:
+            mask (numpy array)
+    """
+    height, width = mask.shape
+    # the frontier is a labeling of the cells that flipped in the previous
+    # round, held over its bounding box starting at (row, col)
+    frontier, row, col = label, 0, 0
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        rows = np.flatnonzero(np.any(frontier, axis=1))
+        cols = np.flatnonzero(np.any(frontier, axis=0))
+        if not rows.size:
+            break
+        rounds += 1
+        # the bounding box of the frontier and its neighbours
+        r_start, r_stop = max(row + rows[0] - 1, 0), min(row + rows[-1] + 2, height)
+        c_start, c_stop = max(col + cols[0] - 1, 0), min(col + cols[-1] + 2, width)
+        padded = np.zeros((r_stop - r_start + 2, c_stop - c_start + 2), dtype=label.dtype)
+        f_start, f_stop = max(row, r_start), min(row + frontier.shape[0], r_stop)
+        g_start, g_stop = max(col, c_start), min(col + frontier.shape[1], c_stop)
+        padded[f_start - r_start + 1:f_stop - r_start + 1,
+               g_start - c_start + 1:g_stop - c_start + 1] = \
+            frontier[f_start - row:f_stop - row, g_start - col:g_stop - col]
+        owner = majority_label(padded, majority)
+        window = mask[r_start:r_stop, c_start:c_stop]
+        flipped = (owner > 0) & (window == 0)
+        if not np.any(flipped):
+            break
+        window[flipped] = 1
+        # a cell holds the majority of at most one cluster, so the frontiers
+        # of the clusters never share a cell
+        frontier, row, col = np.where(flipped, owner, 0), r_start, c_start
+    return mask
+
+
+def majority_label(label, majority=5):
+    """Find the cluster that holds at least `majority` of the eight neighbours of every cell.
+        Args:
+            label (numpy array): cluster labels padded with a 1-cell halo, 0 is the background.
+            majority (int): minimum number of neighbours in the same cluster, more than 4.
+        Returns:
+            numpy array of the labels, 0 where no cluster holds the majority,
+            the shape of label without the halo.
+    """
+    height, width = label.shape[0] - 2, label.shape[1] - 2
+    neighbours = [label[r:r+height, c:c+width]
+                  for r in range(3) for c in range(3) if (r, c) != (1, 1)]
+    # a cluster holding the majority of the 8 neighbours occupies at least one
+    # of any 9 - majority of them, and no other cluster can hold it too
+    out = np.zeros((height, width), dtype=label.dtype)
+    for candidate in neighbours[:9-majority]:
+        count = np.zeros((height, width), dtype=np.int8)
+        for neighbour in neighbours:
+            count += neighbour == candidate
+        np.copyto(out, candidate, where=(candidate > 0) & (count >= majority))
+    return out
+
+
+def majority_rule(label, majority=5):
+    """Find the cells that have at least `majority` of their eight neighbours in one cluster.
+        It gives the same cells as one round of majority_fill, so it can be
+        evaluated tile by tile as long as the labels are global.
+        Args:
+            label (numpy array): cluster labels padded with a 1-cell halo, 0 is the background.
+            majority (int): minimum number of neighbours in the same cluster, more than 4.
+        Returns:
+            numpy bool array, the shape of label without the halo.
+    """
+    return majority_label(label, majority) > 0
@@ -1,15 +1,31 @@
 import os
 import json
 import math
+import contextlib
+import itertools
 import numpy as np
 import rasterio as rio
+import rasterio.shutil
+from collections import OrderedDict
 from rasterio import crs
 from affine import Affine
-from osgeo import gdal, ogr
 from rasterio import features
 from rasterio.windows import Window
+from rasterio.enums import Resampling
 from rasterio.transform import guard_transform
 from rasterio.warp import calculate_default_transform, reproject
+try:
+    from osgeo import gdal, ogr
+except ImportError:
+    # the rasters are read by rasterio, only the vector sources and
+    # clip_raster need the GDAL Python bindings
+    gdal = ogr = None
+
+
+def require_osgeo():
+    if ogr is None:
+        raise ImportError(
+            "The GDAL Python bindings (osgeo) are required to read vector sources. ")
 
 
 def clip_raster(in_raster,
@@ -26,6 +42,7 @@ def clip_raster(in_raster,
             srcSRS, dstSRS: 
             srcNodata, dstNodata: 
     """
+    require_osgeo()
     ds = gdal.Open(in_raster)
     band = ds.GetRasterBand(1)
     if srcSRS == None:
@@ -149,8 +166,98 @@ def geometries_bounds(geometries):
     return (left, bottom, right, top)
 
 
-def geometry_window(geometry, affine):
-    bounds = geometry_bounds(geometry)
+def _geometry_coordinates(geom):
+    """Yield the coordinate sequences of a GeoJSON-like geometry"""
+    geom = geom.get('geometry') or geom
+    geom_type = geom.get('type')
+    if geom_type in ('GeometryCollection', 'FeatureCollection'):
+        for part in geom.get('geometries') or geom.get('features'):
+            yield from _geometry_coordinates(part)
+    elif geom_type == 'Point':
+        yield [geom['coordinates']]
+    elif geom_type in ('LineString', 'MultiPoint'):
+        yield geom['coordinates']
+    elif geom_type in ('Polygon', 'MultiLineString'):
+        yield from geom['coordinates']
+    elif geom_type == 'MultiPolygon':
+        for polygon in geom['coordinates']:
+            yield from polygon
+
+
+def bounds_array(geometries):
+    """Return the bounding boxes of many geometries at once.
+    Shapely geometries and WKB use the vectorized shapely.bounds, GeoJSON-like
+    geometries are concatenated into one coordinate array reduced geometry by
+    geometry, instead of one np.vstack per geometry.
+    Parameters
+    ----------
+    geometries: list of GeoJSON-like objects, shapely geometries or WKB bytes
+
+    Returns
+    -------
+    numpy array of (left, bottom, right, top), shape (n, 4), nan for empty geometries
+    """
+    geometries = list(geometries)
+    if not geometries:
+        return np.zeros((0, 4))
+    first = geometries[0]
+    if isinstance(first, (bytes, bytearray)) or hasattr(first, 'geom_type'):
+        try:
+            import shapely
+            if isinstance(first, (bytes, bytearray)):
+                geometries = shapely.from_wkb(geometries)
+            return shapely.bounds(np.asarray(geometries, dtype=object))
+        except (ImportError, AttributeError):
+            if isinstance(first, (bytes, bytearray)):
+                require_osgeo()
+                envelopes = [ogr.CreateGeometryFromWkb(bytes(geometry)).GetEnvelope()
+                             for geometry in geometries]
+                return np.array(envelopes, dtype=np.float64).reshape(-1, 4)[:, [0, 2, 1, 3]]
+            return np.array([geometry.bounds for geometry in geometries], dtype=np.float64)
+
+    parts, counts = [], np.zeros(len(geometries), dtype=np.int64)
+    bboxes = {}
+    for i, geometry in enumerate(geometries):
+        geom = getattr(geometry, '__geo_interface__', None) or geometry
+        if 'bbox' in geom:
+            bboxes[i] = tuple(geom['bbox'])
+            continue
+        for coordinates in _geometry_coordinates(geom):
+            if len(coordinates):
+                coordinates = np.asarray(coordinates, dtype=np.float64)[:, :2]
+                parts.append(coordinates)
+                counts[i] += len(coordinates)
+    bounds = np.full((len(geometries), 4), np.nan)
+    if parts:
+        coordinates = np.concatenate(parts)
+        filled = counts > 0
+        starts = (np.cumsum(counts) - counts)[filled]
+        low = np.minimum.reduceat(coordinates, starts, axis=0)
+        high = np.maximum.reduceat(coordinates, starts, axis=0)
+        bounds[filled] = np.column_stack([low, high])
+    for i, bbox in bboxes.items():
+        bounds[i] = bbox
+    return bounds
+
+
+def bounds_windows(bounds, affine):
+    """Vectorized bounds_window of an (n, 4) bounds array
+    Returns
+    -------
+    numpy int array of (row_start, row_stop, col_start, col_stop), shape (n, 4)
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    w, s, e, n = bounds.T
+    row_start = np.floor((n - affine.f) / affine.e)
+    col_start = np.floor((w - affine.c) / affine.a)
+    row_stop = np.ceil((s - affine.f) / affine.e)
+    col_stop = np.ceil((e - affine.c) / affine.a)
+    return np.column_stack([row_start, row_stop, col_start, col_stop]).astype(np.int64)
+
+
+def geometry_window(geometry, affine, bounds=None):
+    if bounds is None:
+        bounds = geometry_bounds(geometry)
     window = bounds_window(bounds, affine)
     return window
 
@@ -170,6 +277,9 @@ def overlap(shape, win):
 
 def boundless_array(arr, window):
     """Return a numpy masked array by the window of arr
+    Windows inside the extent of arr are returned as views that share the
+    data and the mask of arr, so they must not be written to. Only windows
+    that cross the extent are padded into a new masked array.
     Parameters
     ----------
     arr: numpy array, 2D or 3D
@@ -188,6 +298,15 @@ def boundless_array(arr, window):
     # unpack for readability
     (wr_start, wr_stop), (wc_start, wc_stop) = window
 
+    if not beyond_extent(window, (height, weight)):
+        if dim3:
+            out = arr[:, wr_start:wr_stop, wc_start:wc_stop]
+        else:
+            out = arr[wr_start:wr_stop, wc_start:wc_stop]
+        if not isinstance(out, np.ma.MaskedArray):
+            out = out.view(np.ma.MaskedArray)
+        return out
+
     # Calculate overlap
     (olr_start, olr_stop), (olc_start, olc_stop) = overlap((height, weight), window)
 
@@ -218,21 +337,110 @@ def boundless_array(arr, window):
     return out
 
 
+def mask_nodata(array, nodata=None):
+    """Return a numpy masked array with the nodata and nan values of array masked
+    Parameters
+    ----------
+    array: numpy array or numpy masked array
+    nodata: int or float, optional
+    """
+    # create a mask array by nodata value
+    if nodata != None:
+        array = np.ma.masked_array(array, array == nodata)
+    # add nan mask (if necessary)
+    if np.issubdtype(array.dtype, np.floating):
+        array = np.ma.masked_array(array, np.isnan(array))
+    else:
+        array = np.ma.masked_array(array, None)
+    return array
+
+
+def _column_array(values):
+    """NumPy array of the values of a column, masked where they are null"""
+    null = np.array([value is None for value in values], dtype=bool)
+    if not np.any(null):
+        return np.asarray(values)
+    filled = [value for value in values if value is not None]
+    fill = type(filled[0])() if filled else None
+    array = np.asarray([fill if value is None else value for value in values])
+    return np.ma.masked_array(array, mask=null)
+
+
+def _decode_strings(array):
+    """Decode the UTF-8 bytes of a string column of an Arrow batch"""
+    data = np.ma.getdata(array)
+    if data.dtype.kind == 'S':
+        data = np.char.decode(data, 'utf-8')
+    elif data.dtype == object and any(isinstance(value, bytes) for value in data):
+        data = np.array([value.decode('utf-8') if isinstance(value, bytes) else value
+                         for value in data], dtype=object)
+    else:
+        return array
+    if np.ma.isMaskedArray(array):
+        return np.ma.masked_array(data, mask=np.ma.getmaskarray(array))
+    return data
+
+
 class Vector(object):
 
-    def __init__(self, path, layer=0):
+    _drivers = {'.gpkg': 'GPKG',
+                '.fgb': 'FlatGeobuf',
+                '.shp': 'ESRI Shapefile',
+                '.geojson': 'GeoJSON',
+                '.json': 'GeoJSON'}
+
+    def __init__(self, path, layer=0, update=False):
+        """
+        Parameters
+        ----------
+        path: path to an vector source
+        layer: int or str, optional
+        update: bool, optional
+            open the source for writing, the in-place writes of create_field
+            and write_fields reopen it when needed, defaults to False
+        """
+        require_osgeo()
         if not os.path.isabs(path):
             path = os.path.abspath(path)
         if not os.path.exists(path):
             raise ValueError("The path {} is not exist.".format(path))
-        self.ds = ogr.Open(path, update=1)
-        self.layer = self.ds.GetLayer(layer)
+        self.path = path
+        self.layer_index = layer
+        self._open(update)
+
+    def _open(self, update):
+        self.update = update
+        self.ds = ogr.Open(self.path, update=int(update))
+        self.layer = self.ds.GetLayer(self.layer_index)
         self.layer_def = self.layer.GetLayerDefn()
+        self._bounds = None
         self.columns = []
         for i in range(self.layer_def.GetFieldCount()):
             field_def = self.layer_def.GetFieldDefn(i)
             self.columns.append(field_def.GetName())
 
+    def bounds(self):
+        """Return the envelopes of the features in the order of iterfeatures,
+        read once with OGR GetEnvelope without building any coordinate array.
+
+        Returns
+        -------
+        numpy array of (left, bottom, right, top), shape (n, 4), nan for the
+        features without geometry
+        """
+        if self._bounds is None:
+            envelopes = []
+            self.layer.ResetReading()
+            feature = self.layer.GetNextFeature()
+            while feature is not None:
+                geom = feature.GetGeometryRef()
+                envelopes.append(geom.GetEnvelope() if geom is not None else (np.nan,) * 4)
+                feature = self.layer.GetNextFeature()
+            self.layer.ResetReading()
+            # GetEnvelope is (min x, max x, min y, max y)
+            self._bounds = np.array(envelopes, dtype=np.float64).reshape(-1, 4)[:, [0, 2, 1, 3]]
+        return self._bounds
+
     def __getitem__(self, column):
         """
         """
@@ -240,23 +448,204 @@ class Vector(object):
                 column not in self.columns):
             raise KeyError("The column {} is not exist. ".format(column))
 
-        values = []
-        feature_count = self.layer.GetFeatureCount()
-        if not feature_count:
-            return values
+        if column == 'geometry':
+            return [geometry for _, geometry, _ in
+                    self.iterfeatures(columns=[], geometry='geojson')]
+        return self.read_columns(columns=[column], geometry=None)[column].tolist()
 
-        for i in range(feature_count):
-            feature = self.layer.GetFeature(i)
-            if column == 'geometry':
-                geom = feature.GetGeometryRef()
-                geom = json.loads(geom.ExportToJson())
-                value = geom
-                # value = shape(geom.ExportToJson())
+    def __len__(self):
+        return self.layer.GetFeatureCount()
+
+    def iterfeatures(self,
+                     columns=None,
+                     geometry='wkb',
+                     spatial_filter=None,
+                     attribute_filter=None):
+        """Iterate over the features by sequential reads, the FIDs may start
+        anywhere and have gaps.
+
+        Parameters
+        ----------
+        columns: list of str, optional
+            attributes to read, defaults to all the columns
+        geometry: str or None, optional
+            format of the geometries, 'wkb' (bytes), 'shapely' or 'geojson',
+            None skips the geometries, defaults to 'wkb'
+        spatial_filter: (left, bottom, right, top) or ogr.Geometry, optional
+            only yield the features that intersect it
+        attribute_filter: str, optional
+            SQL WHERE clause on the attributes, e.g. "pop > 1000"
+
+        Yields
+        ------
+        (fid, geometry, attributes) with attributes a dict of columns
+        """
+        if columns is None:
+            columns = self.columns
+        for column in columns:
+            if column not in self.columns:
+                raise KeyError("The column {} is not exist. ".format(column))
+        if geometry not in ('wkb', 'shapely', 'geojson', None):
+            raise ValueError("The geometry format {} is not avaliable. ".format(geometry))
+        if geometry == 'shapely':
+            from shapely import wkb
+
+        with self._filtered(spatial_filter, attribute_filter):
+            feature = self.layer.GetNextFeature()
+            while feature is not None:
+                geom = None
+                if geometry is not None:
+                    geom = feature.GetGeometryRef()
+                if geom is not None:
+                    if geometry == 'geojson':
+                        geom = json.loads(geom.ExportToJson())
+                    else:
+                        geom = bytes(geom.ExportToWkb())
+                        if geometry == 'shapely':
+                            geom = wkb.loads(geom)
+                attributes = {column: feature.GetField(column) for column in columns}
+                yield feature.GetFID(), geom, attributes
+                feature = self.layer.GetNextFeature()
+
+    @contextlib.contextmanager
+    def _filtered(self, spatial_filter=None, attribute_filter=None):
+        """Set the filters of a sequential read of the layer, cleared on exit"""
+        if spatial_filter is not None:
+            if isinstance(spatial_filter, ogr.Geometry):
+                self.layer.SetSpatialFilter(spatial_filter)
             else:
-                value = feature.GetField(self.columns.index(column))
-            values.append(value)
+                self.layer.SetSpatialFilterRect(*spatial_filter)
+        if attribute_filter is not None:
+            self.layer.SetAttributeFilter(attribute_filter)
+        try:
+            self.layer.ResetReading()
+            yield self.layer
+        finally:
+            if spatial_filter is not None:
+                self.layer.SetSpatialFilter(None)
+            if attribute_filter is not None:
+                self.layer.SetAttributeFilter(None)
+            self.layer.ResetReading()
+
+    def iterbatches(self,
+                    columns=None,
+                    geometry='wkb',
+                    batch_size=65536,
+                    spatial_filter=None,
+                    attribute_filter=None):
+        """Iterate over the features by batches of columns, in the order of
+        iterfeatures. The batches come from the Arrow stream of the layer
+        (GDAL >= 3.6) as NumPy arrays, without a Python object per feature,
+        older GDAL versions fall back to iterfeatures.
+
+        Parameters
+        ----------
+        columns: list of str, optional
+            attributes to read, defaults to all the columns
+        geometry: str or None, optional
+            format of the geometries, 'wkb' (bytes) or 'shapely', None skips
+            the geometries, defaults to 'wkb'
+        batch_size: int, optional
+            maximum number of features of a batch
+        spatial_filter, attribute_filter: optional
+            see iterfeatures
+
+        Yields
+        ------
+        dict of NumPy arrays: 'fid', 'geometry' (object array, None for the
+        features without geometry) and the columns, masked where null
+        """
+        if columns is None:
+            columns = self.columns
+        for column in columns:
+            if column not in self.columns:
+                raise KeyError("The column {} is not exist. ".format(column))
+        if geometry not in ('wkb', 'shapely', None):
+            raise ValueError("The geometry format {} is not avaliable. ".format(geometry))
+
+        if hasattr(self.layer, 'GetArrowStreamAsNumPy'):
+            batches = self._arrow_batches(columns, geometry, batch_size,
+                                          spatial_filter, attribute_filter)
+        else:
+            batches = self._feature_batches(columns, geometry, batch_size,
+                                            spatial_filter, attribute_filter)
+        for batch in batches:
+            if geometry == 'shapely':
+                import shapely
+                batch['geometry'] = shapely.from_wkb(batch['geometry'])
+            yield batch
+
+    def _arrow_batches(self, columns, geometry, batch_size,
+                       spatial_filter, attribute_filter):
+        fid_column = self.layer.GetFIDColumn() or 'OGC_FID'
+        geometry_column = self.layer.GetGeometryColumn() or 'wkb_geometry'
+        ignored = [column for column in self.columns if column not in columns]
+        if geometry is None:
+            ignored.append('OGR_GEOMETRY')
+        options = ['MAX_FEATURES_IN_BATCH={}'.format(int(batch_size)),
+                   'INCLUDE_FID=YES', 'USE_MASKED_ARRAYS=YES']
+        with self._filtered(spatial_filter, attribute_filter) as layer:
+            layer.SetIgnoredFields(ignored)
+            stream = None
+            try:
+                stream = layer.GetArrowStreamAsNumPy(options=options)
+                for arrays in stream:
+                    batch = {'fid': np.asarray(arrays[fid_column], dtype=np.int64)}
+                    if geometry is not None:
+                        batch['geometry'] = np.asarray(arrays[geometry_column], dtype=object)
+                    for column in columns:
+                        batch[column] = _decode_strings(arrays[column])
+                    yield batch
+            finally:
+                # the layer can not be read otherwise while the stream is alive
+                del stream
+                layer.SetIgnoredFields([])
+
+    def _feature_batches(self, columns, geometry, batch_size,
+                         spatial_filter, attribute_filter):
+        features = self.iterfeatures(columns, geometry=geometry and 'wkb',
+                                     spatial_filter=spatial_filter,
+                                     attribute_filter=attribute_filter)
+        while True:
+            chunk = list(itertools.islice(features, int(batch_size)))
+            if not chunk:
+                return
+            fids, geometries, attributes = zip(*chunk)
+            batch = {'fid': np.array(fids, dtype=np.int64)}
+            if geometry is not None:
+                batch['geometry'] = np.empty(len(chunk), dtype=object)
+                batch['geometry'][:] = geometries
+            for column in columns:
+                batch[column] = _column_array([values[column] for values in attributes])
+            yield batch
+
+    def read_columns(self, columns=None, geometry='wkb', batch_size=65536,
+                     spatial_filter=None, attribute_filter=None):
+        """Read whole columns at once, the batches of iterbatches concatenated.
 
-        return values
+        Returns
+        -------
+        dict of NumPy arrays, see iterbatches
+        """
+        if columns is None:
+            columns = self.columns
+        keys = ['fid'] + (['geometry'] if geometry is not None else []) + list(columns)
+        parts = {key: [] for key in keys}
+        for batch in self.iterbatches(columns, geometry, batch_size,
+                                      spatial_filter, attribute_filter):
+            for key in keys:
+                parts[key].append(batch[key])
+        result = {}
+        for key in keys:
+            if not parts[key]:
+                result[key] = np.zeros(0, dtype=np.int64 if key == 'fid' else object)
+            elif len(parts[key]) == 1:
+                result[key] = parts[key][0]
+            elif key == 'geometry':
+                result[key] = np.concatenate(parts[key])
+            else:
+                result[key] = np.ma.concatenate(parts[key])
+        return result
 
     @property
     def geometry(self):
@@ -271,74 +660,490 @@ class Vector(object):
     def create_field(self, name, type,
                      width=50,
                      values=None):
-        if values != None:
-            length = len(values)
-            feature_count = self.layer.GetFeatureCount()
-            if length != feature_count:
+        self.write_fields([(name, type, values)], width=width)
+
+    def _create_copy(self, out_path, driver=None):
+        """Create an empty copy of the layer (spatial reference, geometry type
+        and fields) in a new dataset, an existing dataset is overwritten."""
+        if driver is None:
+            extension = os.path.splitext(out_path)[1].lower()
+            if extension not in self._drivers:
                 raise ValueError(
-                    'The length of input value must be {}. '.format(feature_count))
+                    "Specify the driver of the output {}. ".format(out_path))
+            driver = self._drivers[extension]
+        if os.path.abspath(out_path) == os.path.abspath(self.path):
+            raise ValueError(
+                "The out_path {} is the source, omit it to write the fields in place. ".format(out_path))
+        driver = ogr.GetDriverByName(driver)
+        if os.path.exists(out_path):
+            driver.DeleteDataSource(out_path)
+        ds = driver.CreateDataSource(out_path)
+        layer = ds.CreateLayer(self.layer.GetName(),
+                               srs=self.layer.GetSpatialRef(),
+                               geom_type=self.layer.GetGeomType())
+        for i in range(self.layer_def.GetFieldCount()):
+            layer.CreateField(self.layer_def.GetFieldDefn(i))
+        return ds, layer
+
+    def _features(self):
+        """Iterate over the features of the layer by sequential reads"""
+        with self._filtered() as layer:
+            feature = layer.GetNextFeature()
+            while feature is not None:
+                yield feature
+                feature = layer.GetNextFeature()
+
+    def write_fields(self, fields,
+                     out_path=None,
+                     driver=None,
+                     width=50,
+                     batch_size=10000):
+        """Write several columns in a single pass over the features.
 
-        type = self._type_convert(type)
-        field_def = ogr.FieldDefn(name, type)
-        field_def.SetWidth(width)
-        self.layer.CreateField(field_def)
-        # self.layer_def.AddFieldDefn(field_def)
+        Parameters
+        ----------
+        fields: list of (name, type, values)
+            type is 'int', 'float' or 'string', values are in the order of
+            the features (see iterfeatures), None writes nulls, the values
+            of an existing field are overwritten
+        out_path: str, optional
+            path to a new dataset (GeoPackage, FlatGeobuf, ...) that receives
+            the geometries, the attributes and the new columns, the source is
+            left untouched, it can not be the source. Defaults to None, which
+            writes the columns in place
+        driver: str, optional
+            OGR driver of out_path, defaults to the driver of its extension
+        width: int, optional
+        batch_size: int, optional
+            number of features written by each transaction
 
-        for i in range(feature_count):
-            feature = self.layer.GetFeature(i)
-            if values == None:
-                feature.SetFieldNull(name)
-            value = values[i]
-            feature.SetField(name, value)
-            self.layer.SetFeature(feature)
+        Returns
+        -------
+        io.Vector object of the written dataset
+        """
+        feature_count = self.layer.GetFeatureCount()
+        for name, type, values in fields:
+            if values is not None and len(values) != feature_count:
+                raise ValueError(
+                    'The length of input value must be {}. '.format(feature_count))
 
-        self.columns.append(name)
+        if out_path is None:
+            if not self.update:
+                self._open(update=True)
+            ds, layer = self.ds, self.layer
+        else:
+            ds, layer = self._create_copy(out_path, driver)
+        new_columns = []
+        for name, type, _ in fields:
+            # a field written again (e.g. a classification run twice) is reused
+            if name in self.columns or name in new_columns:
+                continue
+            field_def = ogr.FieldDefn(name, self._type_convert(type))
+            field_def.SetWidth(width)
+            layer.CreateField(field_def)
+            new_columns.append(name)
+        layer_def = layer.GetLayerDefn()
+
+        if out_path is None:
+            # the features are updated by FID after the read, SetFeature must
+            # not run while the layer is read sequentially
+            fids = [fid for fid, _, _ in self.iterfeatures(columns=[], geometry=None)]
+            features = (self.layer.GetFeature(fid) for fid in fids)
+        else:
+            features = self._features()
+
+        transactions = ds.TestCapability(ogr.ODsCTransactions)
+        if transactions:
+            ds.StartTransaction()
+        i = 0
+        for feature in features:
+            if out_path is not None:
+                out_feature = ogr.Feature(layer_def)
+                out_feature.SetFrom(feature)
+            else:
+                out_feature = feature
+            for name, _, values in fields:
+                value = None if values is None else values[i]
+                if value is None:
+                    out_feature.SetFieldNull(name)
+                else:
+                    if isinstance(value, np.generic):
+                        value = value.item()
+                    out_feature.SetField(name, value)
+            if out_path is not None:
+                layer.CreateFeature(out_feature)
+            else:
+                layer.SetFeature(out_feature)
+            i += 1
+            if transactions and i % batch_size == 0:
+                ds.CommitTransaction()
+                ds.StartTransaction()
+        if transactions:
+            ds.CommitTransaction()
+        self.layer.ResetReading()
+
+        if out_path is None:
+            self.columns.extend(new_columns)
+            return self
+        layer = ds = None
+        return Vector(out_path)
 
     def close(self):
-        self.ds.Destroy()
+        # a Vector that failed to open has no dataset
+        if getattr(self, 'ds', None) is not None:
+            self.ds.Destroy()
+            self.ds = None
 
     def __del__(self):
         self.close()
 
 
+# GDAL options of the remote rasters: no directory listing on open, ranges
+# of consecutive blocks merged in one request and an in-memory cache of the
+# downloaded ranges shared by the datasets of the process
+REMOTE_OPTIONS = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff,.vrt',
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+    GDAL_HTTP_MULTIPLEX='YES',
+    GDAL_HTTP_MAX_RETRY=3,
+    GDAL_HTTP_RETRY_DELAY=1,
+    CPL_VSIL_CURL_CACHE_SIZE=256 * 2**20,
+    VSI_CACHE='TRUE',
+    VSI_CACHE_SIZE=64 * 2**20)
+
+
+def overview_levels(shape, blocksize):
+    """Decimation factors of the overviews of a raster down to the tile size
+    Parameters
+    ----------
+    shape: (height, width) of the raster
+    blocksize: int, size of the tiles
+
+    Returns
+    -------
+    list of int, 2, 4, ... until the overview fits in one tile, the levels
+    the GDAL COG driver builds with OVERVIEWS=AUTO
+    """
+    levels = []
+    factor = 1
+    while max(shape) // factor > blocksize:
+        factor *= 2
+        levels.append(factor)
+    return levels
+
+
+def is_remote(path):
+    return path.startswith(('http://', 'https://', '/vsicurl/'))
+
+
+def vsicurl(path):
+    """Return the GDAL path of an http(s) url, /vsicurl/ reads it by range requests"""
+    if path.startswith(('http://', 'https://')):
+        return '/vsicurl/' + path
+    return path
+
+
+class BlockCache(object):
+    """A least recently used cache of decoded raster blocks
+    Parameters
+    ----------
+    max_bytes: int
+        the least recently used blocks are evicted beyond this size
+    """
+
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.blocks = OrderedDict()
+
+    def get(self, key):
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+        return block
+
+    def put(self, key, block):
+        self.blocks[key] = block
+        self.nbytes += block.nbytes + block.mask.nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.nbytes -= evicted.nbytes + evicted.mask.nbytes
+
+    def clear(self):
+        self.blocks.clear()
+        self.nbytes = 0
+
+
+class Mosaic(object):
+    """A seamless mosaic of raster sources on the same grid, read window by window
+    It reads like a rasterio dataset, so no merged copy is written. The
+    sources must share the crs and the resolution and be aligned on the same
+    cell grid, as the WorldPop country rasters are. Where sources overlap, the
+    first valid (not nodata, not nan) value wins.
+    Parameters
+    ----------
+    paths: list of paths to raster sources
+    blocksize: int, optional
+        size of the blocks of a lazy Raster over the mosaic
+    """
+
+    def __init__(self, paths, blocksize=512) -> None:
+        if not paths:
+            raise ValueError("Specify at least one raster source for a mosaic")
+        self.srcs = [rio.open(vsicurl(path), 'r') for path in paths]
+        first = self.srcs[0]
+        res_x, res_y = first.transform.a, first.transform.e
+        for src in self.srcs[1:]:
+            if src.crs != first.crs:
+                raise ValueError(
+                    "The crs of {} differs from the one of {}. ".format(src.name, first.name))
+            if not (math.isclose(src.transform.a, res_x) and math.isclose(src.transform.e, res_y)):
+                raise ValueError(
+                    "The resolution of {} differs from the one of {}. ".format(src.name, first.name))
+        left = min(src.bounds.left for src in self.srcs)
+        top = max(src.bounds.top for src in self.srcs)
+        right = max(src.bounds.right for src in self.srcs)
+        bottom = min(src.bounds.bottom for src in self.srcs)
+
+        self.offsets = []
+        for src in self.srcs:
+            col = (src.bounds.left - left) / res_x
+            row = (src.bounds.top - top) / res_y
+            if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+                raise ValueError(
+                    "The cells of {} are not aligned with the mosaic. ".format(src.name))
+            self.offsets.append((int(round(row)), int(round(col))))
+
+        self.crs = first.crs
+        self.transform = Affine(res_x, 0, left, 0, res_y, top)
+        self.width = int(round((right - left) / res_x))
+        self.height = int(round((bottom - top) / res_y))
+        self.count = min(src.count for src in self.srcs)
+        self.nodata = first.nodata
+        dtype = np.result_type(*[src.dtypes[0] for src in self.srcs])
+        self.dtypes = (dtype.name,) * self.count
+        self.block_shapes = [(min(blocksize, self.height), min(blocksize, self.width))] * self.count
+        self.name = 'mosaic of {} sources'.format(len(self.srcs))
+
+    @property
+    def bounds(self):
+        return rio.coords.BoundingBox(*window_bounds(
+            ((0, self.height), (0, self.width)), self.transform))
+
+    def read(self, indexes=1, window=None, masked=False):
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        elif not isinstance(window, Window):
+            window = Window.from_slices(*window)
+        row, col = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+
+        data = np.zeros((height, width), dtype=self.dtypes[0])
+        mask = np.ones((height, width), dtype=np.bool_)
+        for src, (src_row, src_col) in zip(self.srcs, self.offsets):
+            # the overlap of the window and the source in mosaic cells
+            r_start, r_stop = max(row, src_row), min(row + height, src_row + src.height)
+            c_start, c_stop = max(col, src_col), min(col + width, src_col + src.width)
+            if r_start >= r_stop or c_start >= c_stop:
+                continue
+            block = src.read(indexes, masked=True, window=Window(
+                c_start - src_col, r_start - src_row, c_stop - c_start, r_stop - r_start))
+            block = mask_nodata(block)
+            block_mask = np.ma.getmaskarray(block)
+            sub = (slice(r_start - row, r_stop - row), slice(c_start - col, c_stop - col))
+            fill = mask[sub] & ~block_mask
+            data[sub][fill] = block.data[fill]
+            mask[sub] &= block_mask
+
+        # the cells out of every source hold nodata, as rasterio reads them
+        if self.nodata is not None:
+            data[mask] = self.nodata
+        if masked:
+            return np.ma.masked_array(data, mask)
+        return data
+
+    def close(self):
+        for src in self.srcs:
+            src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_dataset(path):
+    """Open a raster source with rasterio, a list of paths is opened as a Mosaic"""
+    if isinstance(path, (list, tuple)):
+        return Mosaic(path)
+    return rio.open(vsicurl(path), 'r')
+
+
 class Raster(object):
     """Return a numpy masked array by the window of arr
     Parameters
     ----------
-    raster: numpy array or a path to an raster source
+    raster: numpy array, a path to an raster source, a list of paths or an io.Raster
         If raster is a numpy array, it's shape should be 2D or 3D. 
         If raster is a 3D numpy array, it's shape must be (channels, height, weight)
+        A list of paths is read as a seamless Mosaic of the sources
+    lazy: bool, optional
+        only for a path, keep the dataset open and read the windows from the
+        disk block by block instead of loading the whole band, the array is
+        loaded on its first access. Defaults to False for local paths and to
+        True for http(s) urls, which are read by range requests (/vsicurl/)
+    cache_size: int, optional
+        maximum size in bytes of the decoded blocks kept by a lazy raster
+    masked: bool, optional
+        only for a numpy masked array whose nodata cells are already masked,
+        the array and its mask are kept as they are instead of building a
+        new mask, e.g. to keep a memory-mapped mask shared. Defaults to False
     """
 
-    def __init__(self, raster, affine=None, crs=None, nodata=None, band=1) -> None:
+    def __init__(self, raster, affine=None, crs=None, nodata=None, band=1,
+                 lazy=None, cache_size=256 * 2**20, masked=False) -> None:
         self.nodata = nodata
         self.affine = affine
         self.crs = crs
         self.band = band
+        self.src = None
+        self.env = None
+        self._array = None
+        if isinstance(raster, Raster):
+            # e.g. the coarse grid of load_data.block_sum, its array (or its
+            # lazy dataset) is shared, nodata masks more cells if it is given
+            self.__dict__.update(raster.__dict__)
+            if nodata is not None:
+                self.nodata = nodata
+                if self.lazy:
+                    # the blocks are masked with nodata as they are read, in
+                    # a cache of their own
+                    self.cache = BlockCache(raster.cache.max_bytes)
+                else:
+                    self.array = mask_nodata(self.array, nodata)
+            return
         if isinstance(raster, np.ndarray):
             if affine is None or crs is None:
                 raise ValueError(
                     "Specify affine transform and crs for numpy arrays")
             self.array = raster
-        elif isinstance(raster, str):
-            if not os.path.isabs(raster):
-                raster = os.path.abspath(raster)
-            src = rio.open(raster, 'r')
+            if masked and isinstance(raster, np.ma.MaskedArray):
+                self.shape = raster.shape
+                return
+        elif isinstance(raster, (str, list, tuple)):
+            if not isinstance(raster, str):
+                src = Mosaic(raster)
+            elif is_remote(raster):
+                raster = vsicurl(raster)
+                lazy = True if lazy is None else lazy
+                self.env = rio.Env(**REMOTE_OPTIONS)
+                with self.env:
+                    src = rio.open(raster, 'r')
+            else:
+                if not os.path.isabs(raster):
+                    raster = os.path.abspath(raster)
+                src = rio.open(raster, 'r')
             self.affine = guard_transform(src.transform)
             self.crs = src.crs
-            self.array = src.read(self.band, masked=True)
-        # create a mask array by nodata value
-        if self.nodata != None:
-            self.array = np.ma.masked_array(self.array,
-                                            self.array == self.nodata)
-        # add nan mask (if necessary)
-        if np.issubdtype(self.array.dtype, np.floating):
-            self.array = np.ma.masked_array(self.array,
-                                            np.isnan(self.array))
-        else:
-            self.array = np.ma.masked_array(self.array, None)
+            if lazy:
+                self.src = src
+                self.cache = BlockCache(cache_size)
+                self.block_shape = src.block_shapes[self.band - 1]
+                self.shape = (src.height, src.width)
+                return
+            # the dataset (one per source of a Mosaic) is closed once read
+            with self._env(), src:
+                self.array = src.read(self.band, masked=True)
+        self.array = mask_nodata(self.array, self.nodata)
         self.shape = self.array.shape
 
+    @property
+    def array(self):
+        if self._array is None and self.src is not None:
+            with self._env():
+                array = self.src.read(self.band, masked=True)
+            self._array = mask_nodata(array, self.nodata)
+        return self._array
+
+    @property
+    def lazy(self):
+        """True while the raster is read by blocks instead of held in memory"""
+        return self._array is None and self.src is not None
+
+    def tile_shape(self, size=1024):
+        """Shape of the tiles of a tiled read: whole blocks of the dataset
+        covering at least size rows and columns, clipped to the raster"""
+        size = max(int(size), 1)
+        block_height, block_width = getattr(self, 'block_shape', (size, size))
+        return (min(block_height * -(-size // block_height), self.shape[0]),
+                min(block_width * -(-size // block_width), self.shape[1]))
+
+    def _env(self):
+        # the options of a remote raster must be set while it is read
+        return self.env if self.env is not None else contextlib.nullcontext()
+
+    @array.setter
+    def array(self, array):
+        self._array = array
+
+    def _read_block(self, block_row, block_col):
+        key = (block_row, block_col)
+        block = self.cache.get(key)
+        if block is None:
+            height, width = self.block_shape
+            window = Window(block_col * width, block_row * height,
+                            min(width, self.shape[1] - block_col * width),
+                            min(height, self.shape[0] - block_row * height))
+            with self._env():
+                block = self.src.read(self.band, window=window, masked=True)
+            block = mask_nodata(block, self.nodata)
+            self.cache.put(key, block)
+        return block
+
+    def _read_blocks(self, window):
+        """Read a window from the blocks of the dataset, see boundless_array
+        for the views returned by in-extent windows"""
+        (wr_start, wr_stop), (wc_start, wc_stop) = window
+        height, width = self.block_shape
+        block_row, block_col = wr_start // height, wc_start // width
+        if (not beyond_extent(window, self.shape) and
+                (wr_stop - 1) // height == block_row and
+                (wc_stop - 1) // width == block_col):
+            # the window is inside a single block, return a view of it
+            block = self._read_block(block_row, block_col)
+            return block[wr_start - block_row * height:wr_stop - block_row * height,
+                         wc_start - block_col * width:wc_stop - block_col * width]
+
+        # the blocks are stitched together into a new array
+        (or_start, or_stop), (oc_start, oc_stop) = overlap(self.shape, window)
+        out = np.ma.MaskedArray(
+                np.zeros(shape=(wr_stop - wr_start, wc_stop - wc_start),
+                         dtype=self.src.dtypes[self.band - 1]),
+                mask=True)
+        if or_start >= or_stop or oc_start >= oc_stop:
+            return out
+
+        for block_row in range(or_start // height, (or_stop - 1) // height + 1):
+            for block_col in range(oc_start // width, (oc_stop - 1) // width + 1):
+                block = self._read_block(block_row, block_col)
+                # overlap of the block and the window in raster coordinates
+                r_start = max(or_start, block_row * height)
+                r_stop = min(or_stop, block_row * height + block.shape[0])
+                c_start = max(oc_start, block_col * width)
+                c_stop = min(oc_stop, block_col * width + block.shape[1])
+                out[r_start - wr_start:r_stop - wr_start,
+                    c_start - wc_start:c_stop - wc_start] = \
+                    block[r_start - block_row * height:r_stop - block_row * height,
+                          c_start - block_col * width:c_stop - block_col * width]
+        return out
+
+    def close(self):
+        if self.src is not None:
+            self.src.close()
+            self.cache.clear()
+
     def read(self,
              bounds=None,
              window=None,
@@ -378,7 +1183,10 @@ class Raster(object):
             raise ValueError(
                 "Window/bounds is outside dataset extent and boundless reads are disabled")
 
-        out = boundless_array(self.array, window=win)
+        if self.lazy:
+            out = self._read_blocks(win)
+        else:
+            out = boundless_array(self.array, window=win)
 
         if only_array:
             return out
@@ -389,7 +1197,8 @@ class Raster(object):
 
         return Raster(out, new_affine, self.crs)
 
-    def read_from_geometry(self, geometries, boundless=True, all_touched=False):
+    def read_from_geometry(self, geometries, boundless=True, all_touched=False,
+                           bounds=None):
         """
         Parameters
         ----------
@@ -398,13 +1207,17 @@ class Raster(object):
             If True, all pixels touched by geometries will be burned in.  If
             false, only pixels whose center is within the polygon or that
             are selected by Bresenham's line algorithm will be burned in.
+        bounds : (left, bottom, right, top), optional
+            bounding box of the geometries when it is already known, e.g. a
+            row of Vector.bounds or bounds_array
         Returns
         -------
         Raster object with update affine and array info
         """
         if not isinstance(geometries, (tuple, list)):
             geometries = [geometries]
-        bounds = geometries_bounds(geometries)
+        if bounds is None:
+            bounds = geometries_bounds(geometries)
         window = bounds_window(bounds, self.affine)
 
         clip_raster = self.read(window=window, boundless=boundless)
@@ -424,10 +1237,33 @@ class Raster(object):
         return (x, y)
 
     def index(self, x, y):
-        col = int((x - self.affine.c) // self.affine.a)
-        row = int((self.affine.f - y) // abs(self.affine.e))
+        """Return the row and col of the cells holding the points x, y
+        Parameters
+        ----------
+        x, y: float or numpy arrays of the coordinates
+        Returns
+        -------
+        int or numpy int arrays, the points outside the raster get indexes
+        out of its shape (possibly negative)
+        """
+        col = np.floor((np.asarray(x) - self.affine.c) / self.affine.a).astype(np.int64)
+        row = np.floor((np.asarray(y) - self.affine.f) / self.affine.e).astype(np.int64)
+        if col.ndim == 0:
+            return int(row), int(col)
+        return row, col
 
-    def reproject(self, epsg):
+    def reproject(self, epsg, resampling=Resampling.nearest, num_threads=4):
+        """
+        Parameters
+        ----------
+        epsg: int
+            EPSG code of the destination crs
+        resampling: rasterio Resampling, optional
+            Resampling.sum preserves the totals of counts rasters (GDAL >= 3.1),
+            see regrid.regrid for a chunked version
+        num_threads: int, optional
+            number of threads of the warp
+        """
         dst_crs = crs.CRS.from_epsg(epsg)
         height, width = self.shape
         left = self.affine.c
@@ -464,10 +1300,47 @@ class Raster(object):
             dst_transform=dst_transform,
             dst_crs=dst_crs,
             dst_nodata=dst_nodata,
-            num_threads=4)
+            resampling=resampling,
+            num_threads=num_threads)
         return Raster(dst_array, dst_transform, dst_crs, dst_nodata)
 
-    def save(self, path, nodata=None):
+    def save(self, path, nodata=None,
+             profile=None,
+             compress='lzw',
+             predictor=None,
+             blocksize=512,
+             overviews=None,
+             resampling=None,
+             num_threads='ALL_CPUS'):
+        """
+        Parameters
+        ----------
+        path: path to the output GeoTIFF
+        nodata: int or float, optional
+        profile: str, optional
+            None writes a striped GeoTIFF, 'tiled' a tiled GeoTIFF and 'cog' a
+            Cloud Optimized GeoTIFF (GDAL >= 3.1) with internal overviews
+        compress: str, optional
+            'lzw', 'deflate', 'zstd', ... defaults to 'lzw'
+        predictor: bool or int, optional
+            True uses the horizontal differencing predictor (2) for integers
+            and the floating point predictor (3) for floats, defaults to True
+            for the 'tiled' and 'cog' profiles
+        blocksize: int, optional
+            tile size of the 'tiled' and 'cog' profiles
+        overviews: list of int or bool, optional
+            decimation factors of the internal overviews, True builds them down
+            to the tile size (see overview_levels), defaults to True for the
+            'tiled' and 'cog' profiles
+        resampling: str, optional
+            resampling of the overviews, defaults to 'mode' for integers (class
+            rasters) and 'average' for floats, it is recorded in the
+            OVERVIEW_RESAMPLING tag
+        num_threads: int or str, optional
+            number of threads used by GDAL to compress, defaults to 'ALL_CPUS'
+        """
+        if profile not in (None, 'tiled', 'cog'):
+            raise ValueError("The profile {} is not avaliable. ".format(profile))
         # Determine the nodata value
         if nodata == None:
             if self.nodata == None:
@@ -478,14 +1351,53 @@ class Raster(object):
             else:
                 nodata = self.nodata
         arr = self.array.filled(nodata)
-        with rio.open(path, 'w',
-                      driver='GTiff',
-                      nodata=nodata,
-                      height=self.shape[0],
-                      width=self.shape[1],
-                      count=1,
-                      dtype=self.array.dtype,
-                      crs=self.crs,
-                      transform=self.affine,
-                      compress='lzw') as src:
-            src.write(arr, 1)
+
+        floating = np.issubdtype(arr.dtype, np.floating)
+        if predictor is None:
+            predictor = profile is not None
+        if predictor is True:
+            predictor = 3 if floating else 2
+        if overviews is None:
+            overviews = profile is not None
+        if overviews is True:
+            overviews = overview_levels(self.shape, blocksize)
+        if resampling is None:
+            resampling = 'average' if floating else 'mode'
+
+        options = dict(compress=compress, num_threads=num_threads)
+        if predictor:
+            options['predictor'] = predictor
+        if profile == 'tiled':
+            options.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+        dataset = dict(nodata=nodata,
+                       height=self.shape[0],
+                       width=self.shape[1],
+                       count=1,
+                       dtype=self.array.dtype,
+                       crs=self.crs,
+                       transform=self.affine)
+
+        def write(dst):
+            dst.write(arr, 1)
+            if overviews:
+                dst.build_overviews(overviews, Resampling[resampling])
+                # the COG driver only copies the default domain
+                dst.update_tags(OVERVIEW_RESAMPLING=resampling)
+                dst.update_tags(ns='rio_overview', resampling=resampling)
+
+        if profile != 'cog':
+            with rio.open(path, 'w', driver='GTiff', **dataset, **options) as dst:
+                write(dst)
+            return
+
+        # the COG driver can only copy a dataset, the overviews are built at
+        # the same levels as the other profiles in an uncompressed tiled
+        # GeoTIFF in memory and copied as they are
+        with rio.MemoryFile() as memfile:
+            with memfile.open(driver='GTiff', tiled=True, blockxsize=blocksize,
+                              blockysize=blocksize, **dataset) as dst:
+                write(dst)
+            with memfile.open() as src:
+                rio.shutil.copy(src, path, driver='COG', blocksize=blocksize,
+                                overviews='FORCE_USE_EXISTING' if overviews else 'NONE',
+                                **options)
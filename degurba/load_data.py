@@ -1,9 +1,22 @@
 import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import contextlib
 import zipfile
-import tempfile
+import threading
+import http.client
+import urllib.error
+import urllib.parse
 import urllib.request
-from glob import glob
-from .io import Raster, Vector
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio as rio
+from affine import Affine
+from rasterio.windows import Window
+from .io import Raster, Vector, vsicurl
 
 
 gpw_v4_unadjusted_1km = {
@@ -32,9 +45,21 @@ worldPop_adjusted_1km = {
     "base_url": "https://data.worldpop.org/GIS/Population/Global_2000_2020_1km_UNadj/{year}/{country_upper}/{country_lower}_ppp_{year}_1km_Aggregated_UNadj.tif"
 }
 
+worldPop_unadjusted_100m = {
+    "name": "Unconstrained individual countries 2000-2020  ( 100m resolution )",
+    "base_url": "https://data.worldpop.org/GIS/Population/Global_2000_2020/{year}/{country_upper}/{country_lower}_ppp_{year}.tif"
+}
+
+worldPop_adjusted_100m = {
+    "name": "Unconstrained individual countries 2000-2020 UN adjusted  ( 100m resolution )",
+    "base_url": "https://data.worldpop.org/GIS/Population/Global_2000_2020/{year}/{country_upper}/{country_lower}_ppp_{year}_UNadj.tif"
+}
+
 wp_datasets = {
     'worldPop_unadjusted_1km': worldPop_unadjusted_1km,
     'worldPop_adjusted_1km': worldPop_adjusted_1km,
+    'worldPop_unadjusted_100m': worldPop_unadjusted_100m,
+    'worldPop_adjusted_100m': worldPop_adjusted_100m,
     "valid_years": list(range(2000, 2021))
 }
 
@@ -67,63 +92,355 @@ wp_info = {"Algeria": "dza", "Angola": "ago", "Benin": "ben", "Botswana": "bwa",
            "Papua New Guinea": "png", "Samoa": "wsm", "Solomon Islands": "slb", "Tokelau": "tkl", "Tonga": "ton", "Tuvalu": "tuv", "Vanuatu": "vut", "Wallis and Futuna": "wlf"}
 
 
+def block_sum(path, factor=10, band=1, nodata=None, max_memory=64 * 2**20):
+    """Aggregate a fine population counts raster by summing blocks of factor x factor cells.
+        The raster is streamed by bands of factor rows, so only a few rows of the
+        fine grid are held in memory, e.g. a 100 m WorldPop raster to 1 km with
+        factor=10. The blocks at the right and bottom edges may be partial, they
+        sum the cells they hold. Nodata cells count as 0, a block made only of
+        nodata cells is masked.
+        Args:
+            path (str): path to the fine population counts raster.
+            factor (int): number of fine cells along a side of a block.
+            band (int): band of the population counts.
+            nodata (int or float): nodata value, defaults to the one of the raster.
+            max_memory (int): approximate memory budget in bytes of a read.
+        Returns:
+            Raster of the coarse grid, ready for DEGURBA.
+    """
+    with rio.open(path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        height = math.ceil(src.height / factor)
+        width = math.ceil(src.width / factor)
+        pad = width * factor - src.width
+        # the fine rows of a read, as float64 with their mask
+        rows = int(max_memory // (width * factor * factor * 9))
+        rows = max(rows, 1)
+
+        sums = np.zeros((height, width), dtype=np.float64)
+        valid = np.zeros((height, width), dtype=np.bool_)
+        for row in range(0, height, rows):
+            window = Window(0, row * factor, src.width,
+                            min(rows * factor, src.height - row * factor))
+            array = src.read(band, window=window, masked=True)
+            mask = np.ma.getmaskarray(array)
+            if nodata is not None:
+                mask = mask | (array.data == nodata)
+            if np.issubdtype(array.dtype, np.floating):
+                mask = mask | np.isnan(array.data)
+            data = np.where(mask, 0, array.data).astype(np.float64)
+            n = math.ceil(window.height / factor)
+            pad_rows = n * factor - window.height
+            data = np.pad(data, ((0, pad_rows), (0, pad)))
+            mask = np.pad(mask, ((0, pad_rows), (0, pad)), constant_values=True)
+            sums[row:row+n] = data.reshape(n, factor, width, factor).sum(axis=(1, 3))
+            valid[row:row+n] = ~mask.reshape(n, factor, width, factor).all(axis=(1, 3))
+        affine = src.transform * Affine.scale(factor)
+        crs = src.crs
+
+    array = np.ma.masked_array(sums, ~valid)
+    return Raster(array, affine, crs)
+
+
+def find_url(dataset, year, country=None):
+    """Return the url of a dataset.
+        Args:
+            dataset (string): dataset name, see Dataset._datasets.
+            year (int): year of the dataset.
+            country (string): country name of wp_info, only needed when the dataset is worldpop.
+    """
+    if dataset.startswith('worldPop'):
+        country_lower = wp_info[country]
+        country_upper = country_lower.upper()
+        if year not in wp_datasets['valid_years']:
+            raise ValueError(
+                "The dataset {} in {} is not avaliable. ".format(dataset, year))
+        return wp_datasets[dataset]['base_url'].format(
+            year=year, country_upper=country_upper, country_lower=country_lower)
+    elif dataset.startswith('gpw_v4'):
+        return gpw_datasets[dataset]['base_url'].format(year=year)
+    raise ValueError(
+        "The dataset {} is not avaliable. ".format(dataset))
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'degurba')
+
+
+class DownloadCache:
+    """Local cache of downloaded files, keyed by the sha256 of their url.
+        Every entry is stored as <key><ext> next to a <key>.json holding its url,
+        size and sha256. A download goes to <key><ext>.part first, it is resumed
+        with an HTTP Range request after a broken connection or another
+        transient error (see transient), checked against the announced size
+        and the expected checksum, then renamed into place.
+        The least recently used entries are evicted when the cache grows over
+        max_size, except the entries held by hold. The threads that fetch
+        the same url wait for each other, so the url is downloaded once.
+        Args:
+            cache_dir (string): directory of the cache, defaults to ~/.cache/degurba.
+            max_size (int): maximum size in bytes of the cached files.
+            retries (int): number of attempts of a download.
+            chunk_size (int): size in bytes of the reads of a download.
+    """
+
+    def __init__(self, cache_dir=None, max_size=20 * 2**30, retries=5, chunk_size=2**20):
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_size = max_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        # a lock per key and the number of holders of every path
+        self._key_locks = {}
+        self._held = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key_lock(self, url):
+        with self._lock:
+            return self._key_locks.setdefault(self.key(url), threading.Lock())
+
+    @contextlib.contextmanager
+    def hold(self, url, sha256=None, progress=None):
+        """Fetch url and keep its entry from being evicted while the block runs,
+            e.g. while it is copied out of the cache.
+            Yields:
+                path of the file in the cache, see fetch.
+        """
+        path = self.path(url)
+        with self._lock:
+            self._held[path] = self._held.get(path, 0) + 1
+        try:
+            yield self.fetch(url, sha256, progress)
+        finally:
+            with self._lock:
+                self._held[path] -= 1
+                if not self._held[path]:
+                    del self._held[path]
+
+    def key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def path(self, url):
+        ext = os.path.splitext(urllib.parse.urlparse(url).path)[1]
+        return os.path.join(self.cache_dir, self.key(url) + ext)
+
+    def _meta_path(self, url):
+        return os.path.join(self.cache_dir, self.key(url) + '.json')
+
+    @staticmethod
+    def checksum(path, chunk_size=2**20):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def _cached(self, url, sha256=None):
+        """Return the path of a valid entry of url, None if there is none."""
+        path, meta_path = self.path(url), self._meta_path(url)
+        if not (os.path.exists(path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        valid = os.path.getsize(path) == meta['size']
+        if valid and sha256 is not None:
+            valid = meta['sha256'] == sha256.lower()
+        if not valid:
+            self.remove(url)
+            return None
+        # the access time is not reliable (noatime mounts), the mtime is the LRU clock
+        os.utime(path)
+        return path
+
+    @staticmethod
+    def transient(error):
+        """Whether a failed attempt is worth another one: short reads, broken
+            connections, DNS and connection failures (URLError), server errors
+            (5xx) and rate limits (429). The other HTTP errors (404, 403, ...)
+            are final."""
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code >= 500 or error.code == 429
+        return isinstance(error, (urllib.error.URLError, http.client.IncompleteRead,
+                                  ConnectionError, TimeoutError))
+
+    def _fetch(self, url, part, progress=None):
+        """One attempt, resumed from the bytes already in part. Returns the total size."""
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # the range starts at the end of the file, drop the part and restart
+            os.remove(part)
+            return self._fetch(url, part, progress)
+        with response:
+            if response.status == 206:
+                # Content-Range: bytes <start>-<stop>/<total>
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                mode = 'ab'
+            else:
+                # the server ignored the range, start over
+                total = response.headers.get('Content-Length')
+                offset = 0
+                mode = 'wb'
+            total = int(total) if total and total != '*' else None
+            with open(part, mode) as f:
+                if progress is not None:
+                    progress(url, offset, total)
+                for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    if progress is not None:
+                        progress(url, offset, total)
+        size = os.path.getsize(part)
+        if total is not None and size != total:
+            raise urllib.error.ContentTooShortError(
+                "Retrieval incomplete: got only {} out of {} bytes".format(size, total), None)
+        return size
+
+    def fetch(self, url, sha256=None, progress=None):
+        """Return the path of the cached copy of url, downloading it if needed.
+            Args:
+                url (string): url of the file.
+                sha256 (string): expected sha256 of the file, optional.
+                progress (callable): called as progress(url, done, total) while
+                    downloading, total is None when the server does not announce it.
+            Returns:
+                path of the file in the cache.
+        """
+        with self._key_lock(url):
+            return self._fetch_locked(url, sha256, progress)
+
+    def _fetch_locked(self, url, sha256=None, progress=None):
+        path = self._cached(url, sha256)
+        if path is not None:
+            return path
+
+        path = self.path(url)
+        part = path + '.part'
+        for attempt in range(self.retries):
+            try:
+                size = self._fetch(url, part, progress)
+                break
+            except (urllib.error.URLError, http.client.IncompleteRead,
+                    ConnectionError, TimeoutError) as e:
+                if not self.transient(e) or attempt + 1 == self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+        digest = self.checksum(part, self.chunk_size)
+        if sha256 is not None and digest != sha256.lower():
+            os.remove(part)
+            raise ValueError(
+                "The checksum of {} does not match: {} instead of {}. ".format(url, digest, sha256))
+
+        os.replace(part, path)
+        meta_part = self._meta_path(url) + '.part'
+        with open(meta_part, 'w') as f:
+            json.dump({'url': url, 'size': size, 'sha256': digest}, f)
+        os.replace(meta_part, self._meta_path(url))
+        self.evict(keep=path)
+        return path
+
+    def remove(self, url):
+        for path in (self.path(url), self._meta_path(url)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def entries(self):
+        """List the (mtime, size, path, meta path) of the complete entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            path = self.path(meta['url'])
+            if os.path.exists(path):
+                entries.append((os.path.getmtime(path), meta['size'], path, meta_path))
+        return entries
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        with self._lock:
+            entries = sorted(self.entries())
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, path, meta_path in entries:
+                if size <= self.max_size:
+                    break
+                if path == keep or path in self._held:
+                    continue
+                os.remove(path)
+                os.remove(meta_path)
+                size -= entry_size
+
+
 class Dataset:
     _datasets = {
         'gpw_v4_unadjusted_1km',
         'gpw_v4_adjusted_1km',
         'worldPop_unadjusted_1km',
-        'worldPop_adjusted_1km'
+        'worldPop_adjusted_1km',
+        'worldPop_unadjusted_100m',
+        'worldPop_adjusted_100m'
     }
 
     def __init__(
             self,
+            cache_dir=None,
+            max_cache_size=20 * 2**30
             ) -> None:
-        pass
+        """
+            Args:
+                cache_dir (string): directory of the download cache, defaults to ~/.cache/degurba.
+                max_cache_size (int): maximum size in bytes of the download cache.
+        """
+        self.cache = DownloadCache(cache_dir, max_cache_size)
 
     def _find_url(self, dataset, year, country):
-        country_upper, country_lower = None, None
-
         if dataset.startswith('worldPop'):
-            country_lower = wp_info[country]
             print("The country that will be downloaded is {}".format(
                 country))
-            country_upper = country_lower.upper()
-            if year not in wp_datasets['valid_years']:
-                raise ValueError(
-                    "The dataset {} in {} is not avaliable. ".format(dataset, year))
-
-        if dataset.startswith('worldPop'):
             self.dataset = wp_datasets[dataset]
-            self.url = self.dataset['base_url'].format(year=year, country_upper=country_upper,
-                                                       country_lower=country_lower)
         elif dataset.startswith('gpw_v4'):
             self.dataset = gpw_datasets[dataset]
-            self.url = self.dataset['base_url'].format(year=year)
+        self.url = find_url(dataset, year, country)
 
-    def _download(self, dataset) -> None:
-        if dataset.startswith('worldPop'):
-            try:
-                urllib.request.urlretrieve(self.url, self.file_path)
-            except urllib.error.ContentTooShortError:
-                self._download()
-        else:
-            try:
-                urllib.request.urlretrieve(self.url, self.fp.name)
-            except urllib.error.ContentTooShortError:
-                self._download()
+    @contextlib.contextmanager
+    def _download(self, dataset):
+        """Fetch the url through the cache, its entry is held (not evicted by
+            concurrent downloads) while the block reads or clips it."""
+        with self.cache.hold(self.url) as cached_path:
+            self.cached_path = cached_path
+            if dataset.startswith('worldPop'):
+                shutil.copyfile(self.cached_path, self.file_path)
+            yield cached_path
 
     def download(
             self, 
             dataset,
             year,
             country=None,
-            file_path=None
+            file_path=None,
+            mask=None,
+            remote=False
             ) -> None:
         """Download and load Population Counts Dataset.
             Args:
                 dataset (string): dataset name to download.
                 year: year of dataset to download.
                 country: country of dataset to download, only needed when the dataset is worldpop.
+                file_path (string): path of the output raster.
+                mask (string): path to a vector source, the raster is clipped to its
+                    geometries. For the global GPW datasets the clip is read straight
+                    from the zip, the global raster is never extracted.
+                remote (bool): only for worldpop with a mask, read the window of the
+                    mask from the server by range requests instead of downloading
+                    the whole country raster.
         """
         year = int(year)
         if dataset not in self._datasets:
@@ -140,23 +457,116 @@ class Dataset:
         else:
             raise ValueError("The path {} is not exist. ".format(file_path))
 
-        if dataset.startswith('gpw_v4'):
-            self.fp = tempfile.NamedTemporaryFile(suffix='.zip', mode='w', delete=False)
+        if remote:
+            if mask is None or not dataset.startswith('worldPop'):
+                raise ValueError(
+                    "The remote read of {} needs a worldpop dataset and a mask. ".format(dataset))
+            print("Reading " + os.path.basename(self.file_path) + " ... ")
+            self.source = vsicurl(self.url)
+            self.mask(mask)
+            print('Done')
+            return
 
         print("Downloading " + os.path.basename(self.file_path) + " ... ")
-        self._download(dataset)
-        if dataset.startswith('gpw_v4'):
-            z = zipfile.ZipFile(self.fp.name, 'r')
-            target_dir = os.path.dirname(self.file_path)
-            z.extract(path=target_dir)
-            z.close()
-            tif_path = glob(os.path.join(target_dir, '*.tif'))[0]
-            os.rename(tif_path, self.file_path)
-            self.fp.close()
+        with self._download(dataset):
+            if dataset.startswith('gpw_v4'):
+                with zipfile.ZipFile(self.cached_path, 'r') as z:
+                    member = [name for name in z.namelist() if name.endswith('.tif')][0]
+                # GDAL reads the member in place, with seeks into the deflate stream
+                self.source = '/vsizip/{}/{}'.format(self.cached_path, member)
+                if mask is None:
+                    with zipfile.ZipFile(self.cached_path, 'r') as z:
+                        with z.open(member) as src, open(self.file_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, 2**20)
+                    self.source = self.file_path
+            else:
+                self.source = self.file_path
+            # the zip is read and clipped before the entry is released
+            if mask is not None:
+                self.mask(mask)
         print('Done')
 
     def mask(self, shp: str):
+        """Clip the downloaded raster to the geometries of a vector source.
+            Only the window covering the geometries is read from the source,
+            which is the GPW zip itself when download was given a mask, or
+            the server for a remote download.
+            Args:
+                shp (string): path to a vector source.
+        """
         vector = Vector(shp)
-        raster = Raster(self.file_path)
-        raster = raster.read_from_geometry(vector.geometry)
-        raster.save(self.file_path)
+        raster = Raster(self.source, lazy=True)
+        clipped = raster.read_from_geometry(vector.geometry)
+        raster.close()
+        clipped.save(self.file_path)
+        self.source = self.file_path
+
+    def download_many(
+            self,
+            dataset,
+            years,
+            countries=None,
+            out_dir=None,
+            workers=8,
+            per_host=4,
+            progress=None
+            ):
+        """Download a dataset for several years and countries in parallel.
+            The files are fetched through the download cache by a thread pool,
+            at most per_host of them at a time from one server. A failed file
+            does not stop the others, its error is reported in the manifest.
+            The entries of the same url (e.g. the years of a dataset without
+            them in its url) are fetched once and share the path.
+            Args:
+                dataset (string): dataset name to download.
+                years (list of int): years to download.
+                countries (list of string): countries of wp_info, only needed when
+                    the dataset is worldpop, defaults to all of them.
+                out_dir (string): directory the files are copied to, by default the
+                    manifest points to the files of the cache.
+                workers (int): number of threads.
+                per_host (int): maximum number of concurrent connections to a host.
+                progress (callable): called as progress(url, done, total).
+            Returns:
+                manifest (list of dict): one entry per file, in the order of years
+                and countries, with the keys dataset, year, country, url, path and
+                error (None when the file was downloaded).
+        """
+        if dataset not in self._datasets:
+            raise ValueError(
+                "The dataset {} is not avaliable. ".format(dataset))
+        if dataset.startswith('worldPop'):
+            countries = list(wp_info) if countries is None else countries
+        else:
+            countries = [None]
+        manifest = [{'dataset': dataset, 'year': int(year), 'country': country,
+                     'url': find_url(dataset, int(year), country),
+                     'path': None, 'error': None}
+                    for year in years for country in countries]
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+
+        urls = list(dict.fromkeys(entry['url'] for entry in manifest))
+        hosts = {}
+        for url in urls:
+            host = urllib.parse.urlparse(url).netloc
+            hosts.setdefault(host, threading.BoundedSemaphore(per_host))
+
+        def fetch(url):
+            try:
+                with hosts[urllib.parse.urlparse(url).netloc]:
+                    with self.cache.hold(url, progress=progress) as path:
+                        if out_dir is not None:
+                            out_path = os.path.join(out_dir, os.path.basename(
+                                urllib.parse.urlparse(url).path))
+                            shutil.copyfile(path, out_path)
+                            path = out_path
+                return path, None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = dict(zip(urls, executor.map(fetch, urls)))
+        for entry in manifest:
+            entry['path'], entry['error'] = results[entry['url']]
+        return manifest
@@ -1,7 +1,11 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from scipy import ndimage
 from .io import Raster
-from .utils import zonal_stats
+from .utils import zonal_stats, zonal_counts, open_vector, open_raster, center_values, vector_bounds
+from .cluster import cluster_sums, keep_clusters, majority_rule
+from . import tiled
 
 
 class DEGURBA:
@@ -40,21 +44,56 @@ class DEGURBA:
                  affine=None,
                  crs=None,
                  nodata=None,
-                 band=1) -> None:
+                 band=1,
+                 max_memory=None,
+                 workers=1) -> None:
+        """
+        Parameters:
+        -----------
+        pn: path to an raster source, numpy array or io.Raster object of
+            population counts (e.g. the result of load_data.block_sum), a
+            list of paths (e.g. neighbouring WorldPop countries) is classified
+            as one seamless mosaic, so clusters that cross borders stay whole
+        max_memory: int, optional
+            memory budget in bytes, when it is set, pn must be a path (or a list
+            of paths) and the grid cells are classified tile by tile without
+            loading the raster
+        workers: int, optional
+            number of threads of the grid cell classification in memory, the
+            raster is classified by row bands that are joined exactly, None
+            uses all the CPUs, defaults to 1
+        """
+        self.nodata = nodata
+        self.band = band
+        self.max_memory = max_memory
+        self.workers = workers
         if not isinstance(pn, type(None)):
-            self.pn = Raster(pn, affine=affine, crs=crs, nodata=nodata, band=band)
+            if max_memory is not None:
+                if not isinstance(pn, (str, list, tuple)):
+                    raise ValueError("Specify a path to an raster source for the tiled mode")
+                self.pn_path = pn
+            else:
+                self.pn = Raster(pn, affine=affine, crs=crs, nodata=nodata, band=band)
 
-    def _get_urban_centres(self, pn):
-        '''Identify the urban centres (high-density clusters), it is done in four steps.
+    def _label_clusters(self, pn, threshold, structure):
+        """Identify groups of contiguous cells with at least threshold inhabitants and sum their population.
+            The labelings are shared by the level 1 and level 2 classes.
             Args:
                 pn (numpy array): population counts array.
-        '''
-        # First step, identify cells with at least 1500 inhabitants
-        urban_centres_mask = pn >= 1500
-        if isinstance(urban_centres_mask, np.ma.masked_array):
-            urban_centres_mask = urban_centres_mask.data
-        urban_centres_mask = urban_centres_mask.astype(np.byte)
-        # Second, identify groups of contiguous cells using the "four-point contiguity" method
+                threshold (int): minimum number of inhabitants of a cell.
+                structure (numpy array): contiguity of the cells.
+            Returns:
+                label, num_features, sums, counts
+        """
+        mask = pn >= threshold
+        if isinstance(mask, np.ma.masked_array):
+            mask = mask.data
+        label, num_features = ndimage.label(mask, structure=structure)
+        sums, counts = cluster_sums(label, num_features, pn)
+        return label, num_features, sums, counts
+
+    def _get_dense_clusters(self, pn):
+        """Cells with at least 1500 inhabitants grouped by the "four-point contiguity" method."""
         s = np.array(
             [
                 [0, 1, 0],
@@ -62,57 +101,54 @@ class DEGURBA:
                 [0, 1, 0]
             ]
         )
-        label, num_features = ndimage.label(urban_centres_mask, structure=s)
-        # Third step, remove group whose total number of inhabitants less than 50000
-        for i in range(1, num_features+1):
-            mask = label == i
-            if np.sum(pn[mask]) < 50000:
-                urban_centres_mask[mask] = 0
-        # Fouth step, fill gaps and smooth borders by using iterative ‘majority rule’
-        w = np.array(
+        return self._label_clusters(pn, 1500, s)
+
+    def _get_moderate_clusters(self, pn):
+        """Cells with at least 300 inhabitants grouped by the "eight-point contiguity" method."""
+        s = np.array(
             [
                 [1, 1, 1],
-                [1, 0, 1],
+                [1, 1, 1],
                 [1, 1, 1]
             ]
         )
-        for i in range(1, num_features+1):
-            mask = label == i
-            mask = mask.astype(np.byte)
-            while True:
-                mask = ndimage.convolve(
-                    mask, weights=w, mode='constant', cval=0)
-                mask = np.logical_and(mask >= 5, urban_centres_mask == 0)
-                if 0 == np.count_nonzero(mask):
-                    break
-                urban_centres_mask[mask] = 1
-        return urban_centres_mask.astype(np.bool_)
-
-    def _get_urban_clusters(self, pn, urban_centres_mask):
+        return self._label_clusters(pn, 300, s)
+
+    def _get_urban_centres(self, pn, dense_clusters=None):
+        '''Identify the urban centres (high-density clusters), it is done in four steps.
+            Args:
+                pn (numpy array): population counts array.
+                dense_clusters (tuple): result of _get_dense_clusters, optional.
+        '''
+        # First and second step, identify groups of contiguous cells with at least
+        # 1500 inhabitants using the "four-point contiguity" method
+        if dense_clusters is None:
+            dense_clusters = self._get_dense_clusters(pn)
+        label, _, sums, counts = dense_clusters
+        # Third step, remove group whose total number of inhabitants less than 50000
+        keep = keep_clusters(sums, counts, 50000)
+        # Fouth step, fill gaps and smooth borders by using iterative ‘majority rule’
+        # The previous convolution based loop turned its frontier into a boolean
+        # array after the first round, so only one round ever changed the mask,
+        # the round of majority_fill(max_rounds=1) over all the clusters at once.
+        urban_centres_mask = keep[label] | majority_rule(np.pad(label, 1))
+        return urban_centres_mask
+
+    def _get_urban_clusters(self, pn, urban_centres_mask, moderate_clusters=None):
         """Identify the urban clusters (moderate-density clusters), it is done in four steps.
             Args:
                 pn (numpy array): population counts array.
                 urban_centres (numpy array): urban centres. 
+                moderate_clusters (tuple): result of _get_moderate_clusters, optional.
         """
-        # First step, identify cells with at least 300 inhabitants
-        urban_clusters_mask = pn >= 300
-        if isinstance(urban_clusters_mask, np.ma.masked_array):
-            urban_clusters_mask = urban_clusters_mask.data
-        urban_clusters_mask = urban_clusters_mask.astype(np.byte)
-        # Second, identify groups of contiguous cells using the "eight-point contiguity" method
-        s = np.array(
-            [
-                [1, 1, 1],
-                [1, 1, 1],
-                [1, 1, 1]
-            ]
-        )
-        label, num_features = ndimage.label(urban_clusters_mask, structure=s)
+        # First and second step, identify groups of contiguous cells with at least
+        # 300 inhabitants using the "eight-point contiguity" method
+        if moderate_clusters is None:
+            moderate_clusters = self._get_moderate_clusters(pn)
+        label, _, sums, counts = moderate_clusters
         # Third step, remove group whose total number of inhabitants less than 5000
-        for i in range(1, num_features+1):
-            mask = label == i
-            if np.sum(pn[mask]) < 5000:
-                urban_clusters_mask[mask] = 0
+        keep = keep_clusters(sums, counts, 5000)
+        urban_clusters_mask = keep[label].astype(np.byte)
         # Fouth step, overlay the urban centres on urban clusters to identify final urban clusters
         urban_clusters_mask = np.logical_and(urban_clusters_mask,
                                              urban_centres_mask == 0)
@@ -136,58 +172,452 @@ class DEGURBA:
         rural_grid_cells_mask = rural_grid_cells_mask.astype(np.byte)
         return rural_grid_cells_mask.astype(np.bool_)
 
-    def classify_grid_cells_l1(self):
-        pn_array = self.pn.array
-        urban_centres = self._get_urban_centres(pn_array)
+    def _get_dense_urban_clusters(self, urban_centres_mask, dense_clusters):
+        """Identify the dense urban clusters, groups of contiguous cells with at least 1500
+            inhabitants ("four-point contiguity") and 5000 inhabitants in total that are not urban centres.
+            Args:
+                urban_centres_mask (numpy array): urban centres.
+                dense_clusters (tuple): result of _get_dense_clusters.
+        """
+        label, _, sums, counts = dense_clusters
+        keep = keep_clusters(sums, counts, 5000)
+        return np.logical_and(keep[label], urban_centres_mask == False)
+
+    def _get_near_clusters(self, urban_centres_mask, dense_urban_clusters_mask,
+                           moderate_clusters, halo=(0, 0)):
+        """Find the moderate clusters that are at most 2 cells away from urban centres
+            and dense urban clusters.
+            Args:
+                urban_centres_mask (numpy array): urban centres.
+                dense_urban_clusters_mask (numpy array): dense urban clusters.
+                moderate_clusters (tuple): result of _get_moderate_clusters.
+                halo (tuple): number of rows of the masks above and below the rows
+                    of the labels, for a row band.
+            Returns:
+                numpy bool array indexed by label.
+        """
+        label, num_features, _, _ = moderate_clusters
+        near = ndimage.binary_dilation(
+            np.logical_or(urban_centres_mask, dense_urban_clusters_mask),
+            structure=np.ones((3, 3)), iterations=2)
+        near = near[halo[0]:near.shape[0]-halo[1]]
+        return np.bincount(label[near], minlength=num_features+1) > 0
+
+    def _get_semi_dense_urban_clusters(self, urban_centres_mask, dense_urban_clusters_mask,
+                                       urban_clusters_mask, moderate_clusters, near=None):
+        """Split the remaining urban cluster cells into semi-dense urban clusters and 
+            suburban or peri-urban grid cells. An urban cluster is semi-dense if it is at least 
+            2 cells away from urban centres and dense urban clusters.
+            Args:
+                urban_centres_mask (numpy array): urban centres.
+                dense_urban_clusters_mask (numpy array): dense urban clusters.
+                urban_clusters_mask (numpy array): urban clusters.
+                moderate_clusters (tuple): result of _get_moderate_clusters.
+                near (numpy array): result of _get_near_clusters, optional.
+            Returns:
+                semi_dense_urban_clusters_mask, suburban_grid_cells_mask
+        """
+        label = moderate_clusters[0]
+        if near is None:
+            near = self._get_near_clusters(urban_centres_mask, dense_urban_clusters_mask,
+                                           moderate_clusters)
+        remaining = np.logical_and(urban_clusters_mask,
+                                   dense_urban_clusters_mask == False)
+        suburban_grid_cells_mask = np.logical_and(remaining, near[label])
+        semi_dense_urban_clusters_mask = np.logical_and(remaining, ~near[label])
+        return semi_dense_urban_clusters_mask, suburban_grid_cells_mask
+
+    def _get_rural_clusters(self, rural_grid_cells_mask, moderate_clusters):
+        """Identify the rural clusters, groups of contiguous cells with at least 300 inhabitants
+            ("eight-point contiguity") and between 500 and 5000 inhabitants in total.
+            Args:
+                rural_grid_cells_mask (numpy array): rural grid cells.
+                moderate_clusters (tuple): result of _get_moderate_clusters.
+        """
+        label, _, sums, counts = moderate_clusters
+        keep = np.logical_and(keep_clusters(sums, counts, 500),
+                              ~keep_clusters(sums, counts, 5000))
+        return np.logical_and(keep[label], rural_grid_cells_mask)
+
+    def _classify_grid_cells(self, pn, level2=True):
+        """Classify the grid cells from a single labeling pass.
+            Args:
+                pn (numpy array): population counts array.
+                level2 (bool): also classify the level 2 classes.
+            Returns:
+                grid_cells_l1, grid_cells_l2 (numpy arrays), grid_cells_l2 is None if not level2.
+        """
+        if self.workers != 1:
+            return self._classify_grid_cells_bands(pn, level2)
+        dense_clusters = self._get_dense_clusters(pn)
+        moderate_clusters = self._get_moderate_clusters(pn)
+        urban_centres = self._get_urban_centres(pn, dense_clusters)
         urban_clusters = self._get_urban_clusters(
-            pn_array, urban_centres)
+            pn, urban_centres, moderate_clusters)
         rural_grid_cells = self._get_rural_grid_cells(
-            pn_array, urban_centres, urban_clusters)
-        grid_cells_clas = [urban_centres,
-                           urban_clusters, rural_grid_cells]
-        grid_cells_l1 = np.zeros(
-            shape=urban_centres.shape, dtype=np.int8)
-        for grid_cells_cla, index in zip(grid_cells_clas,
-                                         self.grid_cells_l1_cla.values()):
-            grid_cells_l1[grid_cells_cla] = index
-        grid_cells_l1 = Raster(
-            grid_cells_l1, affine=self.pn.affine, crs=self.pn.crs, nodata=0)
-
-        return grid_cells_l1
+            pn, urban_centres, urban_clusters)
+        grid_cells_l1 = self._grid_cells(
+            [urban_centres, urban_clusters, rural_grid_cells], self.grid_cells_l1_cla)
+        if not level2:
+            return grid_cells_l1, None
+        grid_cells_l2 = self._grid_cells_l2(pn, urban_centres, urban_clusters,
+                                            rural_grid_cells, dense_clusters,
+                                            moderate_clusters)
+        return grid_cells_l1, grid_cells_l2
+
+    def _grid_cells(self, grid_cells_clas, classes):
+        grid_cells = np.zeros(shape=grid_cells_clas[0].shape, dtype=np.int8)
+        for grid_cells_cla, index in zip(grid_cells_clas, classes.values()):
+            grid_cells[grid_cells_cla] = index
+        return grid_cells
+
+    def _grid_cells_l2(self, pn, urban_centres, urban_clusters, rural_grid_cells,
+                       dense_clusters, moderate_clusters, near=None):
+        """Classify the level 2 classes from the level 1 classes.
+            Args:
+                near (numpy array): result of _get_near_clusters, optional.
+        """
+        dense_urban_clusters = self._get_dense_urban_clusters(
+            urban_centres, dense_clusters)
+        semi_dense_urban_clusters, suburban_grid_cells = self._get_semi_dense_urban_clusters(
+            urban_centres, dense_urban_clusters, urban_clusters, moderate_clusters, near)
+        rural_clusters = self._get_rural_clusters(
+            rural_grid_cells, moderate_clusters)
+        low_density = pn >= 50
+        if isinstance(low_density, np.ma.masked_array):
+            low_density = low_density.data
+        rural_grid_cells = np.logical_and(rural_grid_cells, ~rural_clusters)
+        low_density_rural_grid_cells = np.logical_and(rural_grid_cells, low_density)
+        very_low_density_rural_grid_cells = np.logical_and(rural_grid_cells, ~low_density)
+        grid_cells_clas = [urban_centres, dense_urban_clusters,
+                           semi_dense_urban_clusters, suburban_grid_cells,
+                           rural_clusters, low_density_rural_grid_cells,
+                           very_low_density_rural_grid_cells]
+        return self._grid_cells(grid_cells_clas, self.grid_cells_l2_cla)
+
+    def _classify_grid_cells_bands(self, pn, level2=True):
+        """Classify the grid cells by row bands in a thread pool, the same classes
+            as a single labeling pass of the whole raster.
+            The bands are labeled concurrently and their clusters joined across
+            the seams (see tiled.stitch_labels), then the majority rule, the
+            masks and the 2-cell distance of the level 2 are evaluated band by
+            band over halos of the neighbouring rows. The SciPy and NumPy kernels
+            release the GIL, so the bands run on several cores.
+            Args:
+                pn (numpy array): population counts array.
+                level2 (bool): also classify the level 2 classes.
+            Returns:
+                grid_cells_l1, grid_cells_l2 (numpy arrays), grid_cells_l2 is None if not level2.
+        """
+        workers = os.cpu_count() if self.workers is None else self.workers
+        # a few bands per thread balance the load
+        bands = tiled.row_bands(pn.shape[0], workers * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def each(func):
+                return list(executor.map(lambda band: func(*band), bands))
+
+            dense_clusters = tiled.stitch_labels(
+                each(lambda start, stop: self._get_dense_clusters(pn[start:stop])),
+                bands, diagonal=False, executor=executor)
+            moderate_clusters = tiled.stitch_labels(
+                each(lambda start, stop: self._get_moderate_clusters(pn[start:stop])),
+                bands, diagonal=True, executor=executor)
+
+            def rows(clusters, start, stop):
+                label, num_features, sums, counts = clusters
+                return label[start:stop], num_features, sums, counts
+
+            # the majority rule of the urban centres needs the labels of the
+            # neighbouring rows
+            label, _, sums, counts = dense_clusters
+            keep = keep_clusters(sums, counts, 50000)
+            urban_centres = np.empty(pn.shape, dtype=np.bool_)
+
+            def centres(start, stop):
+                padded = np.pad(tiled.halo_rows(label, start, stop, 1), ((0, 0), (1, 1)))
+                urban_centres[start:stop] = keep[label[start:stop]] | majority_rule(padded)
+
+            each(centres)
+
+            grid_cells_l1 = np.empty(pn.shape, dtype=np.int8)
+
+            def classify_l1(start, stop):
+                band_pn, band_centres = pn[start:stop], urban_centres[start:stop]
+                urban_clusters = self._get_urban_clusters(
+                    band_pn, band_centres, rows(moderate_clusters, start, stop))
+                rural_grid_cells = self._get_rural_grid_cells(
+                    band_pn, band_centres, urban_clusters)
+                grid_cells_l1[start:stop] = self._grid_cells(
+                    [band_centres, urban_clusters, rural_grid_cells], self.grid_cells_l1_cla)
+
+            each(classify_l1)
+            if not level2:
+                return grid_cells_l1, None
+
+            # the moderate clusters near the urban centres and the dense urban
+            # clusters, over a halo of 2 rows
+            def near_clusters(start, stop):
+                top, bottom = max(start - 2, 0), min(stop + 2, pn.shape[0])
+                band_centres = urban_centres[top:bottom]
+                dense_urban_clusters = self._get_dense_urban_clusters(
+                    band_centres, rows(dense_clusters, top, bottom))
+                return self._get_near_clusters(
+                    band_centres, dense_urban_clusters,
+                    rows(moderate_clusters, start, stop), halo=(start - top, bottom - stop))
+
+            near = np.logical_or.reduce(each(near_clusters))
+            grid_cells_l2 = np.empty(pn.shape, dtype=np.int8)
+            classes = self.grid_cells_l1_cla
+
+            def classify_l2(start, stop):
+                band = grid_cells_l1[start:stop]
+                grid_cells_l2[start:stop] = self._grid_cells_l2(
+                    pn[start:stop], band == classes['urban_centres'],
+                    band == classes['urban_clusters'], band == classes['rural_grid_cells'],
+                    rows(dense_clusters, start, stop), rows(moderate_clusters, start, stop),
+                    near)
+
+            each(classify_l2)
+        return grid_cells_l1, grid_cells_l2
+
+    def _to_raster(self, grid_cells, out_path=None):
+        grid_cells = Raster(
+            grid_cells, affine=self.pn.affine, crs=self.pn.crs, nodata=0)
+        if out_path is not None:
+            grid_cells.save(out_path, nodata=0)
+        return grid_cells
+
+    def classify_grid_cells_l1(self, out_path=None):
+        """
+        Parameters:
+        -----------
+        out_path: path to the output raster, optional
+            required in the tiled mode, where the classes are written block by
+            block and out_path is returned instead of an io.Raster object
+        """
+        if self.max_memory is not None:
+            if out_path is None:
+                raise ValueError("Specify out_path for the tiled mode")
+            tiled.classify_grid_cells_l1(self.pn_path, out_path,
+                                         classes=self.grid_cells_l1_cla,
+                                         max_memory=self.max_memory,
+                                         band=self.band, nodata=self.nodata)
+            return out_path
+
+        grid_cells_l1, _ = self._classify_grid_cells(self.pn.array, level2=False)
+        return self._to_raster(grid_cells_l1, out_path)
+
+    def _check_level2(self):
+        if self.max_memory is not None:
+            raise ValueError(
+                "The tiled mode (max_memory) only classifies the level 1 grid cells, "
+                "the 2-cell distance of the level 2 classes needs the whole raster. "
+                "Create the DEGURBA without max_memory to classify the level 2. ")
+
+    def classify_grid_cells_l2(self, out_path=None):
+        """
+        Parameters:
+        -----------
+        out_path: path to the output raster, optional
+            Not available in the tiled mode (max_memory), which raises a ValueError.
+        """
+        self._check_level2()
+        _, grid_cells_l2 = self._classify_grid_cells(self.pn.array)
+        return self._to_raster(grid_cells_l2, out_path)
+
+    def classify_grid_cells(self):
+        """Classify the grid cells of both levels from the same labeling pass.
+        Returns
+        -------
+        grid_cells_l1, grid_cells_l2: io.Raster objects
+        """
+        self._check_level2()
+        grid_cells_l1, grid_cells_l2 = self._classify_grid_cells(self.pn.array)
+        return self._to_raster(grid_cells_l1), self._to_raster(grid_cells_l2)
+
+    def _classify_local_units_l1(self, counts, total):
+        """Classify the local units by the share of their grid cells in each class.
+            Args:
+                counts (numpy array): cells of each grid_cells_l1_cla class, one row per local unit.
+                total (numpy array): number of cells of each local unit.
+        """
+        classes = list(self.grid_cells_l1_cla.keys())
+        total = np.maximum(total, 1)
+        urban_centres_cells_r = counts[:, classes.index('urban_centres')] / total
+        rural_grid_cells_r = counts[:, classes.index('rural_grid_cells')] / total
+        local_units = np.select(
+            [urban_centres_cells_r >= 0.5, rural_grid_cells_r < 0.5],
+            [self.local_units_l1_cla['cities'],
+             self.local_units_l1_cla['towns_semi_dense_areas']],
+            self.local_units_l1_cla['rural_areas'])
+        return local_units
+
+    def _classify_local_units_l2(self, counts, total):
+        """Classify the local units by the share of their grid cells in each class.
+            Rural areas and towns take the type of grid cells with the largest share,
+            urban centre cells count as dense urban cluster cells for towns.
+            Args:
+                counts (numpy array): cells of each grid_cells_l2_cla class, one row per local unit.
+                total (numpy array): number of cells of each local unit.
+        """
+        classes = list(self.grid_cells_l2_cla.keys())
+
+        def count(*names):
+            return sum(counts[:, classes.index(name)] for name in names)
+
+        total = np.maximum(total, 1)
+        urban_centres_cells_r = count('urban_centre') / total
+        rural_grid_cells_r = count('rural_cluster', 'low_density_rural_grid_cells',
+                                   'very_low_density_rural_grid_cells') / total
+        rural = np.argmax(np.column_stack([
+            count('rural_cluster'),
+            count('low_density_rural_grid_cells'),
+            count('very_low_density_rural_grid_cells')]), axis=1)
+        town = np.argmax(np.column_stack([
+            count('urban_centre', 'dense_urban_cluster'),
+            count('semi_dense_urban_cluster'),
+            count('suburban_peri_urban_grid_cells')]), axis=1)
+        rural = np.array([self.local_units_l2_cal['village'],
+                          self.local_units_l2_cal['dispersed_rural_area'],
+                          self.local_units_l2_cal['mostly_uninhabited_area']])[rural]
+        town = np.array([self.local_units_l2_cal['dense_town'],
+                         self.local_units_l2_cal['semi_dense_town'],
+                         self.local_units_l2_cal['suburban_peri_urban_area']])[town]
+        local_units = np.select(
+            [urban_centres_cells_r >= 0.5, rural_grid_cells_r >= 0.5],
+            [self.local_units_l2_cal['city'], rural], town)
+        return local_units
+
+    def _classify_local_units(self, local_units, field, grid_cells,
+                              grid_cells_cla, classify, all_touched, rasterize,
+                              out_path=None, workers=1, shares=False,
+                              zone_cache=None):
+        categories = list(grid_cells_cla.values())
+        local_units = open_vector(local_units)
+        grid_cells = open_raster(grid_cells)
+
+        if field == None and shares:
+            raise ValueError("Specify a field for the class shares")
+        # the population counts of the shares are summed from the same
+        # rasterized zones as the class counts
+        pn = getattr(self, 'pn', None) if shares else None
+
+        if not rasterize:
+            values = zonal_stats(
+                local_units, grid_cells, field=None,
+                zone_func=ZoneClass(type(self), classify.__name__, categories),
+                all_touched=all_touched,
+                workers=workers)
+            # local units whose center falls out of the raster or on a masked
+            # cell have no class, 0 as the nodata of the grid cells, the same
+            # as the rasterized path below
+            values = np.array([0 if value is None else value for value in values])
+        if rasterize or shares:
+            results = zonal_counts(local_units, grid_cells, categories,
+                                   all_touched=all_touched, workers=workers,
+                                   weights=pn, zone_cache=zone_cache)
+            counts, total = results[:2]
+        if rasterize:
+            values = classify(counts, total)
+            # local units that do not cover any cell center take the class of the cell at their center
+            empty = np.nonzero(total == 0)[0]
+            if len(empty):
+                centers = center_values(grid_cells, vector_bounds(local_units)[empty])
+                values[empty] = centers.filled(0)
+
+        if field == None:
+            return values
+
+        fields = [(field, 'float', np.asarray(values).tolist())]
+        if shares:
+            share = counts / np.maximum(total, 1)[:, np.newaxis]
+            fields += [('{}_s{}'.format(field, value), 'float', share[:, i].tolist())
+                       for i, value in enumerate(categories)]
+            if pn is not None:
+                population, total = results[2:]
+                share = population / np.where(total > 0, total, 1)[:, np.newaxis]
+                fields += [('{}_p{}'.format(field, value), 'float', share[:, i].tolist())
+                           for i, value in enumerate(categories)]
+        return local_units.write_fields(fields, out_path=out_path)
 
     def classify_local_units_l1(self, local_units, field=None, 
-                                grid_cells_l1=None, all_touched=False):
+                                grid_cells_l1=None, all_touched=False,
+                                rasterize=True, out_path=None, workers=1,
+                                shares=False, zone_cache=None):
         """
         Parameters:
         -----------
         local_units: path to an vector source or io.Vector object or ndarray
         grid_cells_l1: the result of classify_grid_cells_l1
+        rasterize: bool, optional
+            rasterize all the local units at once (utils.zonal_counts) instead of
+            reading the grid cells of every local unit one by one, defaults to True
+        out_path: str, optional
+            write the local units with the field to a new dataset (GeoPackage,
+            FlatGeobuf, ...) instead of modifying local_units in place
+        workers: int, optional
+            number of processes the local units are classified with, None uses
+            all the CPUs, see utils.zonal_stats. Defaults to 1
+        shares: bool, optional
+            also write the share of the cells of each grid cell class in
+            <field>_s<class> fields and, when the population counts are loaded,
+            the share of the population living in them in <field>_p<class>
+            fields. Defaults to False
+        zone_cache: zones.ZoneCache or bool, optional
+            keep the rasterized local units on disk, so the next runs on the
+            same grid (other years) skip the rasterization, True uses the
+            default directory, see utils.zonal_counts
         """
         if grid_cells_l1 == None:
             grid_cells_l1 = self.classify_grid_cells_l1()
 
-        def classify(grid_cells):
-            total_count = grid_cells.count()
-            if not total_count:
-                return 0
-            urban_centres = self.grid_cells_l1_cla['urban_centres']
-            urban_centres_cells_r = np.count_nonzero(
-                grid_cells == urban_centres) / total_count
+        return self._classify_local_units(
+            local_units, field, grid_cells_l1, self.grid_cells_l1_cla,
+            self._classify_local_units_l1, all_touched, rasterize,
+            out_path, workers, shares, zone_cache)
 
-            if urban_centres_cells_r >= 0.5:
-                return self.local_units_l1_cla['cities']
+    def classify_local_units_l2(self, local_units, field=None,
+                                grid_cells_l2=None, all_touched=False,
+                                rasterize=True, out_path=None, workers=1,
+                                shares=False, zone_cache=None):
+        """
+        The level 1 class of a local unit is its level 2 class divided by 10.
 
-            rural_grid_cells = self.grid_cells_l1_cla['rural_grid_cells']
-            rural_grid_cells_r = np.count_nonzero(
-                grid_cells == rural_grid_cells) / total_count
+        Parameters:
+        -----------
+        local_units: path to an vector source or io.Vector object or ndarray
+        grid_cells_l2: the result of classify_grid_cells_l2
+        rasterize, out_path, workers, shares, zone_cache: optional
+            see classify_local_units_l1
+        """
+        if grid_cells_l2 == None:
+            grid_cells_l2 = self.classify_grid_cells_l2()
 
-            if urban_centres_cells_r < 0.5 and rural_grid_cells_r < 0.5:
-                return self.local_units_l1_cla['towns_semi_dense_areas']
+        return self._classify_local_units(
+            local_units, field, grid_cells_l2, self.grid_cells_l2_cla,
+            self._classify_local_units_l2, all_touched, rasterize,
+            out_path, workers, shares, zone_cache)
 
-            if rural_grid_cells_r >= 0.5:
-                return self.local_units_l1_cla['rural_areas']
 
-        local_units = zonal_stats(
-            local_units, grid_cells_l1, field=field, 
-            zone_func=classify, all_touched=all_touched)
-        return local_units
+class ZoneClass:
+    """The zone_func of the local units classified zone by zone.
+        It is a module level callable holding the class and the name of the
+        classification, so it can be pickled to the workers of zonal_stats
+        with any start method (spawn on macOS and Windows), which a closure
+        over a bound method can not.
+        Args:
+            cls (type): DEGURBA or a subclass of it.
+            name (string): name of the method that classifies the counts, e.g.
+                '_classify_local_units_l1'.
+            categories (list): grid cell classes counted in every zone.
+    """
+
+    def __init__(self, cls, name, categories):
+        self.cls = cls
+        self.name = name
+        self.categories = categories
+
+    def __call__(self, grid_cells):
+        classify = getattr(self.cls(), self.name)
+        counts = [np.count_nonzero(grid_cells == value) for value in self.categories]
+        return classify(np.array([counts]), np.array([grid_cells.count()]))[0]
@@ -0,0 +1,167 @@
+import os
+import math
+import shutil
+import tempfile
+import collections
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .io import Raster, bounds_array, bounds_window
+
+
+def morton(cols, rows, bits=16):
+    """Interleave the bits of integer grid coordinates (Z-order curve)."""
+    code = np.zeros(len(cols), dtype=np.uint64)
+    cols = cols.astype(np.uint64)
+    rows = rows.astype(np.uint64)
+    for bit in range(bits):
+        code |= ((cols >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        code |= ((rows >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return code
+
+
+def spatial_batches(bounds, batch_size):
+    """Split zones into batches of neighbouring zones.
+        The zones are sorted by the Z-order of the centres of their bounding
+        boxes, so the zones of a batch cover a compact part of the raster.
+        Args:
+            bounds (numpy array): (left, bottom, right, top) of every zone, shape (n, 4).
+            batch_size (int): number of zones of a batch.
+        Returns:
+            list of numpy arrays of zone indexes.
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    if not len(bounds):
+        return []
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    scale = (2**16 - 1)
+
+    def grid(values):
+        span = np.max(values) - np.min(values)
+        if not span > 0:
+            return np.zeros(len(values))
+        return np.floor((values - np.min(values)) / span * scale)
+
+    order = np.argsort(morton(grid(x), grid(y)), kind='stable')
+    return [order[i:i+batch_size] for i in range(0, len(order), batch_size)]
+
+
+def batches_window(geometries, affine, bounds=None):
+    """Window of the raster covering all the geometries of a batch, bounds
+    is the io.bounds_array of the geometries when it is already known."""
+    if bounds is None:
+        bounds = bounds_array(geometries)
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    return bounds_window((np.nanmin(bounds[:, 0]), np.nanmin(bounds[:, 1]),
+                          np.nanmax(bounds[:, 2]), np.nanmax(bounds[:, 3])), affine)
+
+
+class SharedRaster:
+    """A copy of a raster that worker processes map instead of unpickling.
+        The data and the mask are written once to .npy files of a temporary
+        directory, the workers open them with np.load(mmap_mode='r') so the
+        pages are shared through the page cache.
+        Args:
+            raster (io.Raster): the raster to share.
+    """
+
+    def __init__(self, raster):
+        self.dir = tempfile.mkdtemp(prefix='degurba-')
+        array = raster.array
+        data_path = os.path.join(self.dir, 'data.npy')
+        mask_path = os.path.join(self.dir, 'mask.npy')
+        np.save(data_path, np.ma.getdata(array))
+        np.save(mask_path, np.ma.getmaskarray(array))
+        self.spec = (data_path, mask_path, raster.affine, raster.crs)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_shared(spec):
+    data_path, mask_path, affine, crs = spec
+    data = np.load(data_path, mmap_mode='r')
+    mask = np.load(mask_path, mmap_mode='r')
+    # masked keeps the memory-mapped mask instead of a private copy per worker
+    return Raster(np.ma.masked_array(data, mask), affine, crs, masked=True)
+
+
+# state of a worker process, set once by its initializer
+_worker = {}
+
+
+def _init_worker(specs, shared):
+    rasters = [open_shared(spec) for spec in specs]
+    _worker['raster'] = rasters[0] if len(rasters) == 1 else tuple(rasters)
+    _worker['shared'] = shared
+
+
+def _run_batch(func, batch):
+    return func(_worker['raster'], batch, *_worker['shared'])
+
+
+def map_batches(raster, func, batches, workers, shared=()):
+    """Run func on batches of zones in a process pool.
+        Args:
+            raster (io.Raster or tuple): raster the zones are read from, or a
+                tuple of rasters, shared with the workers through SharedRasters.
+            func (callable): module level function called as
+                func(raster, batch, *shared) in the workers.
+            batches (list): the batches, pickled to the workers.
+            workers (int): number of processes.
+            shared (tuple): arguments given once to every worker. They are
+                inherited by forked workers, with the spawn start method they
+                must be picklable.
+        Returns:
+            list of the results of func, in the order of batches.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(batches)))
+    return list(imap_batches(raster, func, batches, workers, shared))
+
+
+def imap_batches(raster, func, batches, workers, shared=(), in_flight=2):
+    """Run func on an iterable of batches in a process pool, see map_batches.
+        The batches are taken from the iterable as the results come back, at
+        most in_flight batches per worker are pending, so a generator (e.g.
+        the batches of a vector read from the disk) is never held whole.
+        Yields:
+            the results of func, in the order of batches.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        for batch in batches:
+            yield func(raster, batch, *shared)
+        return
+
+    rasters = raster if isinstance(raster, tuple) else (raster,)
+    shared_rasters = [SharedRaster(raster) for raster in rasters]
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=([r.spec for r in shared_rasters], shared)) as executor:
+            futures = collections.deque()
+            for batch in batches:
+                futures.append(executor.submit(_run_batch, func, batch))
+                if len(futures) >= workers * in_flight:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    finally:
+        for shared_raster in shared_rasters:
+            shared_raster.close()
+
+
+def batch_size(num_zones, workers, per_worker=4):
+    """A batch size that gives every worker a few batches to balance the load."""
+    if workers is None:
+        workers = os.cpu_count()
+    return max(1, math.ceil(num_zones / (max(workers, 1) * per_worker)))
@@ -0,0 +1,143 @@
+import math
+import os
+import numpy as np
+import rasterio as rio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.warp import calculate_default_transform, reproject, transform
+
+
+# equal-area projections for the 1 km grid
+MOLLWEIDE = 'ESRI:54009'
+LAEA_EUROPE = 'EPSG:3035'
+
+
+def equal_area_grid(src, crs=MOLLWEIDE, resolution=1000):
+    """Return the transform, width and height of the grid covering src in crs
+    The origin is snapped to a multiple of resolution, so the grids of
+    different inputs (years, datasets) share their cells.
+    Parameters
+    ----------
+    src: rasterio dataset
+    crs: str or CRS, optional
+        equal-area coordinate reference system, defaults to Mollweide
+    resolution: int or float, optional
+        cell size in the units of crs, defaults to 1000
+    """
+    dst_transform, width, height = calculate_default_transform(
+        src.crs, CRS.from_user_input(crs), src.width, src.height, *src.bounds,
+        resolution=resolution)
+    left, top = dst_transform.c, dst_transform.f
+    right = left + width * resolution
+    bottom = top - height * resolution
+    left = math.floor(left / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    width = math.ceil((right - left) / resolution)
+    height = math.ceil((top - bottom) / resolution)
+    return Affine(resolution, 0, left, 0, -resolution, top), width, height
+
+
+def source_window(src, dst_crs, dst_transform, window, step=64, pad=2):
+    """Return the window of src that covers a window of the destination grid,
+    None if the window does not reach src
+    The edges and an inner lattice of the window are transformed, as the
+    points outside the domain of some projections (Mollweide) are not finite.
+    """
+    rows = np.unique(np.r_[np.arange(0, window.height, step), window.height])
+    cols = np.unique(np.r_[np.arange(0, window.width, step), window.width])
+    rows, cols = np.meshgrid(rows + window.row_off, cols + window.col_off)
+    xs, ys = dst_transform * (cols.ravel(), rows.ravel())
+    xs, ys = transform(dst_crs, src.crs, xs, ys)
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    if not np.any(finite):
+        return None
+    cols, rows = ~src.transform * (xs[finite], ys[finite])
+    # pad by the lattice step in source cells: the footprint may bulge
+    # between the points
+    scale = max((np.max(cols) - np.min(cols)) / window.width,
+                (np.max(rows) - np.min(rows)) / window.height, 1)
+    margin = pad + step * scale
+    row_start = max(int(math.floor(np.min(rows) - margin)), 0)
+    row_stop = min(int(math.ceil(np.max(rows) + margin)), src.height)
+    col_start = max(int(math.floor(np.min(cols) - margin)), 0)
+    col_stop = min(int(math.ceil(np.max(cols) + margin)), src.width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def regrid(path, out_path,
+           crs=MOLLWEIDE,
+           resolution=1000,
+           band=1,
+           nodata=None,
+           max_memory=256 * 2**20,
+           num_threads=None):
+    """Regrid a population counts raster onto an equal-area grid, 1 km by default
+    The population is aggregated by sum (GDAL >= 3.1), so the counts of the
+    source cells are split between the destination cells they overlap and
+    the total population is preserved. The destination is processed by
+    chunks of rows, each one only reads the window of the source it covers.
+    GDAL estimates the footprint of the sum kernel per chunk, so the cells
+    may differ slightly between chunk sizes, the totals do not.
+    Parameters
+    ----------
+    path: path to an raster source of population counts
+    out_path: path to the output GeoTIFF
+    crs: str or CRS, optional
+        equal-area coordinate reference system, MOLLWEIDE (default) or LAEA_EUROPE
+    resolution: int or float, optional
+        cell size in the units of crs, defaults to 1000
+    band: int, optional
+    nodata: int or float, optional
+        nodata value of the source, defaults to its own nodata value
+    max_memory: int, optional
+        approximate memory budget in bytes of a chunk
+    num_threads: int, optional
+        number of threads of the warp, defaults to the number of CPUs
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    dst_crs = CRS.from_user_input(crs)
+
+    with rio.open(path, 'r') as src:
+        src_nodata = src.nodata if nodata is None else nodata
+        dst_nodata = np.nan if src_nodata is None else src_nodata
+        dst_transform, width, height = equal_area_grid(src, dst_crs, resolution)
+
+        # a chunk holds the destination rows and the source rows they cover
+        src_rows = max(src.height / height, 1) + 2
+        row_bytes = width * 4 + src_rows * src.width * 8
+        rows = int(max_memory // row_bytes)
+        if rows < 1:
+            raise ValueError(
+                "The max_memory {} is too small to hold a row of {} cells. ".format(max_memory, width))
+
+        profile = dict(driver='GTiff', height=height, width=width, count=1,
+                       dtype=np.float32, nodata=dst_nodata, crs=dst_crs,
+                       transform=dst_transform, compress='lzw',
+                       tiled=True, blockxsize=256, blockysize=256)
+        with rio.open(out_path, 'w', **profile) as dst:
+            for row in range(0, height, rows):
+                window = Window(0, row, width, min(rows, height - row))
+                destination = np.full((window.height, window.width),
+                                      dst_nodata, dtype=np.float32)
+                src_window = source_window(src, dst_crs, dst_transform, window)
+                if src_window is not None:
+                    source = src.read(band, window=src_window).astype(np.float32)
+                    reproject(
+                        source=source,
+                        src_crs=src.crs,
+                        src_transform=src.window_transform(src_window),
+                        src_nodata=src_nodata,
+                        destination=destination,
+                        dst_transform=dst.window_transform(window),
+                        dst_crs=dst_crs,
+                        dst_nodata=dst_nodata,
+                        resampling=Resampling.sum,
+                        num_threads=num_threads)
+                dst.write(destination, 1, window=window)
+    return out_path
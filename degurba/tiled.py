@@ -0,0 +1,251 @@
+import numpy as np
+import rasterio as rio
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from rasterio.windows import Window
+from .io import mask_nodata, open_dataset
+from .cluster import cluster_sums, keep_clusters, majority_rule
+
+
+# Approximate number of bytes held for every cell of a row band: the
+# population window and its mask, two labelings with their global ids and
+# the neighbourhood comparisons of the majority rule.
+BYTES_PER_CELL = 96
+
+
+def row_windows(height, width, max_memory, bytes_per_cell=BYTES_PER_CELL):
+    """Split a raster into full-width row bands that fit in max_memory.
+        Args:
+            height, width (int): shape of the raster.
+            max_memory (int): memory budget in bytes.
+            bytes_per_cell (int): memory needed by one cell of a band.
+        Returns:
+            list of rasterio windows.
+    """
+    rows = int(max_memory // (width * bytes_per_cell))
+    if rows < 1:
+        raise ValueError(
+            "The max_memory {} is too small to hold a row of {} cells. ".format(max_memory, width))
+    return [Window(0, row, width, min(rows, height - row))
+            for row in range(0, height, rows)]
+
+
+def seam_pairs(upper, lower, diagonal=False):
+    """Pairs of labels that touch across a horizontal seam.
+        Args:
+            upper (numpy array): last label row of the upper band.
+            lower (numpy array): first label row of the lower band.
+            diagonal (bool): also connect diagonal neighbours ("eight-point contiguity").
+        Returns:
+            numpy array of shape (n, 2).
+    """
+    pairs = [np.column_stack([upper, lower])]
+    if diagonal:
+        pairs.append(np.column_stack([upper[:-1], lower[1:]]))
+        pairs.append(np.column_stack([upper[1:], lower[:-1]]))
+    pairs = np.vstack(pairs)
+    pairs = pairs[np.all(pairs > 0, axis=1)]
+    return np.unique(pairs, axis=0)
+
+
+def merge_labels(num_labels, pairs):
+    """Union-find of the band labels that are connected across seams.
+        Args:
+            num_labels (int): number of global labels.
+            pairs (list of numpy array): result of seam_pairs.
+        Returns:
+            numpy array mapping every global label to its merged cluster,
+            the background 0 stays 0.
+    """
+    pairs = np.vstack(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                       shape=(num_labels+1, num_labels+1))
+    _, roots = connected_components(graph, directed=False)
+    # the background has no pairs, so it is a cluster on its own
+    roots = roots + 1
+    roots[0] = 0
+    return roots
+
+
+def _offset(label, offset):
+    label = label.astype(np.int64)
+    label[label > 0] += offset
+    return label
+
+
+def row_bands(height, num_bands):
+    """Split the rows of a raster into consecutive bands of about the same height.
+        Returns:
+            list of (start, stop) rows.
+    """
+    edges = np.linspace(0, height, max(1, min(num_bands, height)) + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:])
+            if start < stop]
+
+
+def halo_rows(array, start, stop, size):
+    """Rows start to stop of array with size rows above and below, zero rows
+        beyond the edges of array.
+    """
+    top, bottom = max(start - size, 0), min(stop + size, array.shape[0])
+    rows = array[top:bottom]
+    return np.pad(rows, ((size - (start - top), size - (bottom - stop)), (0, 0)))
+
+
+def stitch_labels(labels, bands, diagonal, executor=None):
+    """Join the clusters labeled band by band into the clusters of the whole raster.
+        The labels of the bands are offset, the clusters that touch across the
+        seams are merged by a union-find and their population summed, so the
+        result holds the same clusters as a labeling of the whole raster.
+        Args:
+            labels (list): (label, num_features, sums, counts) of every row band,
+                see DEGURBA._label_clusters.
+            bands (list): (start, stop) rows of the consecutive bands.
+            diagonal (bool): also connect diagonal neighbours ("eight-point contiguity").
+            executor (Executor): relabels the bands concurrently, optional.
+        Returns:
+            label, num_features, sums, counts of the whole raster, as
+            DEGURBA._label_clusters.
+    """
+    offsets = np.cumsum([0] + [num_features for _, num_features, _, _ in labels])
+    pairs = [seam_pairs(_offset(upper[0][-1], offsets[i]),
+                        _offset(lower[0][0], offsets[i+1]), diagonal)
+             for i, (upper, lower) in enumerate(zip(labels[:-1], labels[1:]))]
+    roots = merge_labels(int(offsets[-1]), pairs)
+    num_features = int(roots.max())
+    sums = np.bincount(roots, weights=np.concatenate(
+        [np.zeros(1)] + [sums[1:] for _, _, sums, _ in labels]), minlength=num_features+1)
+    counts = np.bincount(roots, weights=np.concatenate(
+        [np.zeros(1)] + [counts[1:] for _, _, _, counts in labels]), minlength=num_features+1)
+
+    height = bands[-1][1]
+    width = labels[0][0].shape[1]
+    label = np.empty((height, width),
+                     dtype=np.int32 if num_features < 2**31 else np.int64)
+
+    def relabel(i):
+        start, stop = bands[i]
+        label[start:stop] = roots[_offset(labels[i][0], offsets[i])]
+
+    list((map if executor is None else executor.map)(relabel, range(len(bands))))
+    return label, num_features, sums, counts
+
+
+class _Level:
+    """Labels of one density level (threshold and contiguity) over all the bands."""
+
+    def __init__(self, threshold, min_population, structure):
+        self.threshold = threshold
+        self.min_population = min_population
+        self.structure = structure
+        self.diagonal = bool(structure[0][0])
+        self.offsets = []
+        self.edges = []
+        self.pairs = []
+        self.sums = [np.zeros(1)]
+        self.counts = [np.zeros(1)]
+        self.num_labels = 0
+
+    def _label(self, pn):
+        mask = pn >= self.threshold
+        if isinstance(mask, np.ma.masked_array):
+            mask = mask.data
+        return ndimage.label(mask, structure=self.structure)
+
+    def label(self, pn, index):
+        """Global labels of the band at index, the band must have been added before."""
+        label, _ = self._label(pn)
+        return _offset(label, self.offsets[index])
+
+    def add(self, pn):
+        """First pass: label a band, sum its clusters and record its seam."""
+        label, num_features = self._label(pn)
+        sums, counts = cluster_sums(label, num_features, pn)
+        self.sums.append(sums[1:])
+        self.counts.append(counts[1:])
+        label = _offset(label, self.num_labels)
+        first, last = label[0].copy(), label[-1].copy()
+        if self.edges:
+            self.pairs.append(seam_pairs(self.edges[-1][1], first, self.diagonal))
+        self.edges.append((first, last))
+        self.offsets.append(self.num_labels)
+        self.num_labels += num_features
+
+    def merge(self):
+        """Resolve the seams and the clusters that pass the population threshold."""
+        self.roots = merge_labels(self.num_labels, self.pairs)
+        num_roots = int(self.roots.max())
+        sums = np.bincount(self.roots, weights=np.concatenate(self.sums),
+                           minlength=num_roots+1)
+        counts = np.bincount(self.roots, weights=np.concatenate(self.counts),
+                             minlength=num_roots+1)
+        self.keep = keep_clusters(sums, counts, self.min_population)
+
+
+def classify_grid_cells_l1(path, out_path, classes, max_memory,
+                           band=1, nodata=None):
+    """Level-1 grid cell classification of a raster source that does not fit in memory.
+        The raster is streamed twice by full-width row bands. The first pass labels
+        every band and sums its clusters, clusters that cross the band seams are
+        merged by a union-find so the population totals stay global. The second
+        pass labels the bands again, applies the thresholds and the majority rule
+        and writes the classes block by block.
+        Args:
+            path (str or list): path to the population counts raster, a list of
+                paths is read as a seamless Mosaic.
+            out_path (str): path to the output GeoTIFF.
+            classes (dict): class values, see DEGURBA.grid_cells_l1_cla.
+            max_memory (int): memory budget of a band in bytes.
+            band (int): band of the population counts.
+            nodata (int or float): nodata value of the population counts.
+    """
+    four = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+    eight = np.ones((3, 3), dtype=np.int64)
+    # urban centres: 1500 inhabitants per cell, 50000 per cluster, "four-point contiguity"
+    centres = _Level(1500, 50000, four)
+    # urban clusters: 300 inhabitants per cell, 5000 per cluster, "eight-point contiguity"
+    clusters = _Level(300, 5000, eight)
+
+    with open_dataset(path) as src:
+        windows = row_windows(src.height, src.width, max_memory)
+
+        def read(window):
+            array = src.read(band, window=window, masked=True)
+            return mask_nodata(array, nodata)
+
+        for window in windows:
+            pn = read(window)
+            centres.add(pn)
+            clusters.add(pn)
+        centres.merge()
+        clusters.merge()
+
+        profile = dict(driver='GTiff', height=src.height, width=src.width,
+                       count=1, dtype=np.int8, nodata=0, crs=src.crs,
+                       transform=src.transform, compress='lzw')
+        with rio.open(out_path, 'w', **profile) as dst:
+            for i, window in enumerate(windows):
+                pn = read(window)
+                label = centres.label(pn, i)
+                urban_centres = centres.keep[centres.roots[label]]
+                # the majority rule needs the neighbouring rows of the next bands
+                upper = centres.edges[i-1][1] if i > 0 else np.zeros(src.width, np.int64)
+                lower = centres.edges[i+1][0] if i+1 < len(windows) else np.zeros(src.width, np.int64)
+                padded = np.pad(np.vstack([upper, label, lower]), ((0, 0), (1, 1)))
+                urban_centres |= majority_rule(centres.roots[padded])
+
+                label = clusters.label(pn, i)
+                urban_clusters = clusters.keep[clusters.roots[label]]
+                urban_clusters &= ~urban_centres
+
+                rural_grid_cells = pn >= 0
+                if isinstance(rural_grid_cells, np.ma.masked_array):
+                    rural_grid_cells = rural_grid_cells.data
+                rural_grid_cells &= ~urban_centres & ~urban_clusters
+
+                grid_cells_l1 = np.zeros(pn.shape, dtype=np.int8)
+                grid_cells_l1[urban_centres] = classes['urban_centres']
+                grid_cells_l1[urban_clusters] = classes['urban_clusters']
+                grid_cells_l1[rural_grid_cells] = classes['rural_grid_cells']
+                dst.write(grid_cells_l1, 1, window=window)
@@ -1,7 +1,11 @@
 import numpy as np
 import os
-from .io import Raster, Vector, geometry_window, overlap
-from .io import geometry_bounds
+import itertools
+import collections
+from .io import Raster, Vector
+from .io import geometry_bounds, bounds_array
+from .parallel import spatial_batches, batches_window, imap_batches, batch_size
+from .zones import rasterize_zones, tile_index, ZoneCache
 
 
 def stat_func(array, stat):
@@ -18,6 +22,371 @@ def stat_func(array, stat):
     return stats[stat](array)
 
 
+def stats_values(values, stats):
+    """Compute several statistics of the valid values of a zone together.
+    Parameters
+    ----------
+    values: 1D numpy array of the unmasked cells of the zone
+    stats: list of str, see stat_func
+    Returns
+    -------
+    dict of the statistics, None for an empty zone
+    """
+    if not values.size:
+        return {stat: None for stat in stats}
+    out = {}
+    if 'count' in stats:
+        out['count'] = values.size
+    if {'sum', 'mean', 'std'} & set(stats):
+        # float rasters are summed in double precision
+        total = values.sum(dtype=np.float64 if np.issubdtype(values.dtype, np.floating) else None)
+        mean = total / values.size
+        if 'sum' in stats:
+            out['sum'] = total
+        if 'mean' in stats:
+            out['mean'] = mean
+        if 'std' in stats:
+            out['std'] = np.sqrt(np.mean(np.square(values - mean)))
+    if {'min', 'max', 'range'} & set(stats):
+        low, high = values.min(), values.max()
+        for stat, value in (('min', low), ('max', high), ('range', high - low)):
+            if stat in stats:
+                out[stat] = value
+    if 'median' in stats:
+        out['median'] = np.median(values)
+    unknown = set(stats) - set(out)
+    if unknown:
+        raise ValueError("The statistics {} are not avaliable. ".format(sorted(unknown)))
+    # python scalars for the fields
+    return {stat: out[stat].item() if hasattr(out[stat], 'item') else out[stat]
+            for stat in stats}
+
+
+def stat_type(stat, dtype):
+    """Field type of a statistic of a raster of dtype"""
+    if stat == 'count':
+        return 'int'
+    if stat in ('min', 'max', 'sum', 'range') and np.issubdtype(dtype, np.integer):
+        return 'int'
+    return 'float'
+
+
+def open_vector(vector):
+    """Return an io.Vector object from a path to an vector source or io.Vector object"""
+    if isinstance(vector, str):
+        if not os.path.exists(vector):
+            raise ValueError("The vector {} is not exist.".format(vector))
+        else:
+            vector = Vector(vector)
+    return vector
+
+
+def open_raster(raster, affine=None, crs=None, nodata=None):
+    """Return an io.Raster object from a path to an raster source or io.Raster object"""
+    if isinstance(raster, str):
+        if not os.path.exists(raster):
+            raise ValueError("The vector {} is not exist.".format(raster))
+        else:
+            raster = Raster(raster, affine=affine, crs=crs, nodata=nodata)
+    return raster
+
+
+def vector_batches(vector, batch_size=65536):
+    """Iterate over the zones of a vector by batches, in the order of its features.
+    An io.Vector is read by columnar batches of WKB decoded at once into
+    NumPy arrays of shapely geometries (see io.Vector.iterbatches), so only
+    the geometries of one batch are held at a time. Without shapely the
+    features are read one by one as GeoJSON-like dicts, a list (or array)
+    of geometries is split as it is.
+
+    Parameters
+    ----------
+    vector: io.Vector object or list of geometries
+    batch_size: int, optional
+        number of zones of a batch
+
+    Yields
+    ------
+    (start, geometries, bounds): index of the first zone of the batch, its
+    geometries and their io.bounds_array
+    """
+    batches = None
+    if hasattr(vector, 'iterbatches'):
+        try:
+            import shapely
+        except ImportError:
+            shapely = None
+        if shapely is not None:
+            batches = (batch['geometry'] for batch in vector.iterbatches(
+                columns=[], geometry='shapely', batch_size=batch_size))
+    if batches is None and hasattr(vector, 'iterfeatures'):
+        features = (geometry for _, geometry, _ in
+                    vector.iterfeatures(columns=[], geometry='geojson'))
+        batches = iter(lambda: list(itertools.islice(features, batch_size)), [])
+    elif batches is None:
+        batches = (vector[i:i + batch_size] for i in range(0, len(vector), batch_size))
+    start = 0
+    for geometries in batches:
+        yield start, geometries, bounds_array(geometries)
+        start += len(geometries)
+
+
+def vector_bounds(vector):
+    """Return the bounding boxes of the features of a vector, shape (n, 4).
+    An io.Vector reads the envelopes of its features once and keeps them,
+    otherwise they are computed batch by batch, see vector_batches.
+
+    Parameters
+    ----------
+    vector: io.Vector object or list of geometries
+    """
+    if callable(getattr(vector, 'bounds', None)):
+        return vector.bounds()
+    bounds = [batch_bounds for _, _, batch_bounds in vector_batches(vector)]
+    return np.concatenate(bounds) if bounds else np.zeros((0, 4))
+
+
+def center_values(raster, bounds):
+    """Return the raster values at the centers of bounding boxes
+    The cells are read with a single fancy indexing of the array, a lazy
+    raster only reads the blocks that hold a center, one window per block.
+
+    Parameters
+    ----------
+    raster: io.Raster object
+    bounds: numpy array of (left, bottom, right, top), shape (n, 4)
+
+    Returns
+    -------
+    numpy masked array of n values, masked where the center falls out of
+    the raster or on a masked cell
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    rows, cols = raster.index(center_x, center_y)
+    height, width = raster.shape
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    if not raster.lazy:
+        array = raster.array
+        values = np.ma.masked_all(len(bounds), dtype=array.dtype)
+        values[inside] = array[rows[inside], cols[inside]]
+        return values
+
+    values = np.ma.masked_all(len(bounds), dtype=raster.src.dtypes[raster.band - 1])
+    index = np.nonzero(inside)[0]
+    block_height, block_width = raster.block_shape
+    block_rows, block_cols = rows[index] // block_height, cols[index] // block_width
+    blocks = block_rows * (width // block_width + 1) + block_cols
+    order = np.argsort(blocks, kind='stable')
+    index, blocks = index[order], blocks[order]
+    _, starts = np.unique(blocks, return_index=True)
+    for block in np.split(index, starts[1:]) if len(index) else []:
+        row, col = rows[block[0]] // block_height, cols[block[0]] // block_width
+        window = ((row * block_height, min((row + 1) * block_height, height)),
+                  (col * block_width, min((col + 1) * block_width, width)))
+        array = raster.read(window=window, only_array=True)
+        values[block] = array[rows[block] - window[0][0], cols[block] - window[1][0]]
+    return values
+
+
+def center_value(raster, geometry):
+    """Return the raster value at the center of the bounding box of geometry"""
+    return center_values(raster, [geometry_bounds(geometry)])[0]
+
+
+def zonal_counts(vector,
+                 raster,
+                 categories,
+                 affine=None,
+                 crs=None,
+                 nodata=None,
+                 all_touched=False,
+                 workers=1,
+                 weights=None,
+                 zone_cache=None
+                 ):
+    """Count the cells of every category in every zone.
+    The zones are read by batches (see vector_batches), the zones of a batch
+    are rasterized into one zone id raster over the window that covers them,
+    and the counts come from a single bincount over (zone id, category),
+    so only one batch of geometries is held at a time. The zones whose window
+    holds a cell covered by more than one geometry are counted geometry by
+    geometry instead, because the zone id raster only keeps the last of them,
+    see zones.rasterize_zones. A lazy raster (read by blocks) is counted tile
+    by tile, each tile read once, see zones.tile_index.
+
+    Parameters
+    ----------
+    vector: path to an vector source, io.Vector object or list of geometries
+    raster: path to an raster source or io.Raster object
+    categories: list of raster values to count
+    affine, crs, nodata: see zonal_stats
+    all_touched: bool, optional
+        see zonal_stats
+    workers: int, optional
+        see zonal_stats, every batch of zones is rasterized over its own window
+    weights: path to an raster source or io.Raster object, optional
+        weights of the cells on the grid of raster (e.g. the population
+        counts), the cells are also summed by their weight from the same
+        rasterized zones, masked weights count as 0
+    zone_cache: zones.ZoneCache or bool, optional
+        reuse the zones rasterized by a previous run on the same grid, True
+        uses a ZoneCache in the default directory
+
+    Returns
+    -------
+    counts: numpy array of shape (number of zones, number of categories)
+    total: numpy array of the number of unmasked cells in every zone
+    sums, sums_total: only with weights, the same as counts and total with
+        the cells summed by their weight
+    """
+    vector = open_vector(vector)
+    raster = open_raster(raster, affine=affine, crs=crs, nodata=nodata)
+    if weights is not None:
+        weights = open_raster(weights)
+        if weights.shape != raster.shape or weights.affine != raster.affine:
+            raise ValueError("The weights must be on the grid of the raster")
+
+    if zone_cache is True:
+        zone_cache = ZoneCache()
+    elif zone_cache is False:
+        zone_cache = None
+
+    num_zones = len(vector)
+    weighted = weights is not None
+    results = _empty_counts(num_zones, len(categories), weighted)
+    rasters = raster if weights is None else (raster, weights)
+    if workers == 1 or num_zones < 2:
+        # the zones are read and counted batch by batch
+        for start, geometries, bounds in vector_batches(vector):
+            if raster.lazy:
+                batch_results = _tiled_counts(
+                    geometries, bounds, raster, categories, all_touched,
+                    weights, zone_cache)
+            else:
+                batch_results = _batch_counts(
+                    rasters, (geometries, bounds), categories, all_touched,
+                    zone_cache)
+            for result, batch_result in zip(results, batch_results):
+                result[start:start + len(geometries)] = batch_result
+        return results
+
+    for indexes, batch_results in _map_zones(
+            rasters, _batch_counts, vector, workers,
+            shared=(categories, all_touched, zone_cache)):
+        for result, batch_result in zip(results, batch_results):
+            result[indexes] = batch_result
+    return results
+
+
+def _empty_counts(num_zones, num_categories, weighted=False):
+    """Zero counts and totals of zonal_counts, and the weighted ones"""
+    results = (np.zeros((num_zones, num_categories), dtype=np.int64),
+               np.zeros(num_zones, dtype=np.int64))
+    if weighted:
+        results += (np.zeros((num_zones, num_categories), dtype=np.float64),
+                    np.zeros(num_zones, dtype=np.float64))
+    return results
+
+
+def _map_zones(raster, func, vector, workers, shared=()):
+    """Run func on spatial batches of the zones in a process pool, see
+    parallel.imap_batches. The vector is read batch by batch (see
+    vector_batches) while the workers count the previous ones.
+    Yields (zone indexes, result) of every batch."""
+    size = batch_size(len(vector), workers)
+    indexes = collections.deque()
+
+    def batches():
+        for start, geometries, bounds in vector_batches(vector):
+            for batch in spatial_batches(bounds, size):
+                indexes.append(start + batch)
+                yield [geometries[i] for i in batch], bounds[batch]
+
+    # the results come back in the order of the batches
+    for result in imap_batches(raster, func, batches(), workers, shared):
+        yield indexes.popleft(), result
+
+
+def _batch_counts(raster, batch, categories, all_touched, zone_cache=None):
+    """zonal_counts of a batch of (geometries, bounds) over the window that covers them"""
+    geometries, bounds = batch
+    raster, weights = raster if isinstance(raster, tuple) else (raster, None)
+    window = batches_window(geometries, raster.affine, bounds)
+    if weights is not None:
+        weights = weights.read(window=window)
+    return _zonal_counts(geometries, raster.read(window=window),
+                         categories, all_touched, weights, zone_cache, bounds)
+
+
+def _tiled_counts(geometries, bounds, raster, categories, all_touched,
+                  weights=None, zone_cache=None):
+    """zonal_counts of a raster read by windows, tile by tile.
+    Every tile of whole blocks is read once and the zones that overlap it are
+    counted over it, see zones.tile_index, the partial counts of the zones
+    that span several tiles are added up."""
+    results = _empty_counts(len(geometries), len(categories), weights is not None)
+    for window, zones in tile_index(bounds, raster.shape, raster.affine,
+                                    raster.tile_shape()):
+        tile_weights = None if weights is None else weights.read(window=window)
+        tile_results = _zonal_counts(
+            [geometries[i] for i in zones], raster.read(window=window),
+            categories, all_touched, tile_weights, zone_cache, bounds[zones])
+        for result, tile_result in zip(results, tile_results):
+            result[zones] += tile_result
+    return results
+
+
+def _zonal_counts(geometries, raster, categories, all_touched, weights=None,
+                  zone_cache=None, bounds=None):
+    num_zones = len(geometries)
+    num_categories = len(categories)
+    if not num_zones:
+        return _empty_counts(0, num_categories, weights is not None)
+
+    if zone_cache is None:
+        zones = rasterize_zones(geometries, raster.shape, raster.affine, all_touched,
+                                bounds)
+    else:
+        zones = zone_cache.zones(geometries, raster.shape, raster.affine, all_touched,
+                                 bounds)
+
+    # the last column counts the unmasked cells of other values
+    data = np.ma.getdata(raster.array).ravel()
+    category = np.full(data.shape, num_categories, dtype=np.int64)
+    for i, value in enumerate(categories):
+        category[data == value] = i
+    valid = ~np.ma.getmaskarray(raster.array).ravel()
+    if weights is not None:
+        weights = weights.array.astype(np.float64).filled(0).ravel()
+
+    def count(cells, ids=None):
+        inside = valid[cells]
+        cells = cells[inside]
+        keys = category[cells]
+        minlength = num_categories + 1
+        if ids is not None:
+            keys = ids[inside].astype(np.int64) * (num_categories + 1) + keys
+            minlength *= num_zones + 1
+        counts = [np.bincount(keys, minlength=minlength)]
+        if weights is not None:
+            # the weighted sums come from the same keys
+            counts.append(np.bincount(keys, weights=weights[cells], minlength=minlength))
+        return counts
+
+    counts = [c.reshape(num_zones + 1, num_categories + 1)[1:]
+              for c in count(zones.cells, zones.ids)]
+    for k, i in enumerate(zones.overlapping):
+        for c, zone_counts in zip(counts, count(zones.zone_cells(k))):
+            c[i] = zone_counts
+
+    results = ()
+    for c in counts:
+        results += (c[:, :num_categories], c.sum(axis=1))
+    return results
+
+
 def zonal_stats(vector, 
                 raster,
                 field, 
@@ -26,7 +395,9 @@ def zonal_stats(vector,
                 nodata=None,
                 stat=None,
                 zone_func=None,
-                all_touched=False
+                all_touched=False,
+                out_path=None,
+                workers=1
                 ):
     """
     Parameters
@@ -42,61 +413,146 @@ def zonal_stats(vector,
         Coordinate reference systems defines how a dataset’s pixels map to locations on, 
         for example, a globe or the Earth.
     nodata: int or float, optional
-    stat: str 
+    stat: str or list of str
         Which statistics to calculate for each zone. 
         The optional parameters are min, max, mean, sum, count, std, median, range
+        A list computes all of them in one pass over the zones, each one is
+        written to its own field named <field>_<stat>. count is an integer
+        field, so are min, max, sum and range of an integer raster, the
+        others are float fields
     zone_func: callable
         function to apply to zone ndarray prior to computing stats
     all_touched: bool, optional
         Whether to include every raster cell touched by a geometry, or only
         those having a center point within the polygon.
         defaults to `False`
+    out_path: str, optional
+        write the vector with the field to a new dataset instead of
+        modifying the source, see io.Vector.write_fields
+    workers: int, optional
+        number of processes, None uses all the CPUs. The zones read by
+        batches (see vector_batches) are split into batches of
+        neighbouring zones and the raster is shared with the
+        workers through a memory map. With 1 the zones of a lazy raster
+        are visited tile by tile, see tile_order. zone_func is inherited by forked
+        workers, with the spawn start method it must be picklable.
+        defaults to 1
+    Returns
+    -------
+    the values of the zones in the order of the features when field is None,
+    a dict of them by statistic when stat is a list
     """
     if stat and zone_func:
         raise ValueError("Specify either stat or zone_func")
 
-    if isinstance(vector, str):
-        if not os.path.exists(vector):
-            raise ValueError("The vector {} is not exist.".format(vector))
-        else:
-            vector = Vector(vector)
+    vector = open_vector(vector)
+    raster = open_raster(raster, affine=affine, crs=crs, nodata=nodata)
 
-    if isinstance(raster, str):
-        if not os.path.exists(raster):
-            raise ValueError("The vector {} is not exist.".format(raster))
-        else:
-            raster = Raster(raster, affine=affine, crs=crs, nodata=nodata)
+    if zone_func is not None and not callable(zone_func):
+        raise TypeError(('zone_func must be a callable '
+                         'which accepts function a '
+                         'single `zone_array` arg.'))
+
+    values = [None] * len(vector)
+    if workers == 1:
+        # the zones are read and their statistics computed batch by batch
+        for start, geometries, bounds in vector_batches(vector):
+            order = range(len(geometries))
+            if raster.lazy:
+                # visit the zones tile by tile, so the blocks of a tile are
+                # decoded once while its zones are read
+                order = tile_order(bounds, raster)
+            for i in order:
+                values[start + i] = zone_value(raster, geometries[i], stat, zone_func,
+                                               all_touched, bounds[i])
+    else:
+        for indexes, batch_values in _map_zones(
+                raster, _batch_values, vector, workers,
+                shared=(stat, zone_func, all_touched)):
+            for i, value in zip(indexes, batch_values):
+                values[i] = value
 
-    values = []
-    for geometry in vector['geometry']:
-        clip_raster = raster.read_from_geometry([geometry], all_touched=all_touched)
-        array = clip_raster.array
-        geometry_mask = ~array.mask
-        if not np.any(geometry_mask):
-            left, bottom, right, top = geometry_bounds(geometry)
-            center_x, center_y = (left + right) / 2, (bottom + top) / 2
-            center_row, center_col = raster.index(center_x, center_y)
-            value = raster.array[center_row, center_col]
-            values.append(int(value))
-            continue
-
-        if stat != None:
-            value = stat_func(array, stat)
-            values.append(int(value))
-            continue
-
-        # execute zone_func on masked zone ndarray
-        if zone_func is not None:
-            if not callable(zone_func):
-                raise TypeError(('zone_func must be a callable '
-                                 'which accepts function a '
-                                 'single `zone_array` arg.'))
-            value = zone_func(array)
-            values.append(int(value))
-            continue
+    # the zones that do not cover any cell center take the cell at the
+    # center of their bounding box, sampled all at once
+    empty = [i for i, value in enumerate(values) if isinstance(value, EmptyZone)]
+    if empty:
+        centers = center_values(raster, [values[i].bounds for i in empty])
+        for i, value in zip(empty, centers):
+            values[i] = center_stat(value, stat, zone_func)
+
+    if isinstance(stat, (list, tuple)):
+        columns = {name: [value[name] for value in values] for name in stat}
+        if field == None:
+            return columns
+        dtype = raster.array.dtype
+        return vector.write_fields(
+            [('{}_{}'.format(field, name), stat_type(name, dtype), columns[name])
+             for name in stat], out_path=out_path)
 
     if field != None:
-        vector.create_field(name=field, type='float', values=values)
-        return vector
+        type = stat_type(stat, raster.array.dtype) if stat else 'float'
+        return vector.write_fields([(field, type, values)], out_path=out_path)
+    return values
+
+
+def tile_order(bounds, raster):
+    """Order of the zones by the first tile of the raster they overlap, see
+    zones.tile_index, the zones outside of the raster come last. A tile holds
+    a quarter of the block cache of the raster, so the blocks of the tile
+    and of its neighbours stay cached while its zones are read."""
+    cell_bytes = np.dtype(raster.src.dtypes[raster.band - 1]).itemsize + 1
+    size = int(np.sqrt(raster.cache.max_bytes / (4 * cell_bytes)))
+    tiles = tile_index(bounds, raster.shape, raster.affine, raster.tile_shape(size))
+    zones = np.concatenate([zones for _, zones in tiles] + [np.arange(len(bounds))])
+    _, first = np.unique(zones, return_index=True)
+    return zones[np.sort(first)]
+
+
+class EmptyZone:
+    """Placeholder of a zone that does not cover any cell center"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+
+def zone_value(raster, geometry, stat=None, zone_func=None, all_touched=False,
+               bounds=None):
+    """Return the statistic of the cells of one zone, a dict of them when stat
+    is a list, see zonal_stats. An EmptyZone is returned for a zone that does
+    not cover any cell center, see center_stat. bounds is the bounding box of
+    the zone when it is already known."""
+    if bounds is None:
+        bounds = geometry_bounds(geometry)
+    clip_raster = raster.read_from_geometry([geometry], all_touched=all_touched,
+                                            bounds=bounds)
+    array = clip_raster.array
+    geometry_mask = ~array.mask
+    if not np.any(geometry_mask):
+        return EmptyZone(bounds)
+
+    if stat != None:
+        stats = stat if isinstance(stat, (list, tuple)) else [stat]
+        values = stats_values(array.compressed(), stats)
+        return values if isinstance(stat, (list, tuple)) else values[stat]
+
+    # execute zone_func on masked zone ndarray
+    if zone_func is not None:
+        value = zone_func(array)
+        return value.item() if hasattr(value, 'item') else value
+
+
+def center_stat(value, stat=None, zone_func=None):
+    """The statistic of a zone reduced to the cell at its center, see center_values.
+    zone_func is not applied, the zone takes the value of the cell."""
+    if zone_func is not None:
+        return None if np.ma.is_masked(value) else value.item()
+    cells = np.zeros(0) if np.ma.is_masked(value) else np.asarray([value])
+    stats = stat if isinstance(stat, (list, tuple)) else [stat]
+    values = stats_values(cells, stats)
+    return values if isinstance(stat, (list, tuple)) else values[stat]
 
 
+def _batch_values(raster, batch, stat, zone_func, all_touched):
+    geometries, bounds = batch
+    return [zone_value(raster, geometry, stat, zone_func, all_touched, zone_bounds)
+            for geometry, zone_bounds in zip(geometries, bounds)]
@@ -0,0 +1,269 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from rasterio import features
+from rasterio.enums import MergeAlg
+from .io import geometry_window, window_bounds, bounds_windows, bounds_array
+from affine import Affine
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'degurba', 'zones')
+
+
+class Zones:
+    """The cells of the zones of a vector on a raster grid, as sparse indexes.
+        Args:
+            cells (numpy array): flat indexes of the cells covered by a zone.
+            ids (numpy array): zone id (1-based) of every cell of cells, the last
+                zone burned when several zones cover a cell.
+            overlapping (numpy array): indexes of the zones that share a cell of
+                their window with another zone.
+            overlap_cells (numpy array): flat indexes of the cells of each
+                overlapping zone, one after the other.
+            overlap_offsets (numpy array): start of the cells of each overlapping
+                zone in overlap_cells, with a last item at its end.
+    """
+
+    def __init__(self, cells, ids, overlapping, overlap_cells, overlap_offsets):
+        self.cells = cells
+        self.ids = ids
+        self.overlapping = overlapping
+        self.overlap_cells = overlap_cells
+        self.overlap_offsets = overlap_offsets
+
+    def zone_cells(self, k):
+        """Flat indexes of the cells of the k-th overlapping zone"""
+        return self.overlap_cells[self.overlap_offsets[k]:self.overlap_offsets[k+1]]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.cells, self.ids, self.overlapping,
+                                              self.overlap_cells, self.overlap_offsets))
+
+
+def _index_dtype(shape):
+    return np.uint32 if shape[0] * shape[1] < 2**32 else np.int64
+
+
+def overlapping_zones(geometries, overlaps, affine, bounds=None):
+    """Return the index of the geometries whose window holds an overlapping cell,
+    bounds is the io.bounds_array of the geometries when it is already known"""
+    height, width = overlaps.shape
+    # summed area table of the overlapping cells
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(overlaps, axis=0), axis=1)
+    if bounds is None:
+        bounds = bounds_array(geometries)
+    windows = bounds_windows(bounds, affine)
+    r_start, r_stop = np.clip(windows[:, 0], 0, height), np.clip(windows[:, 1], 0, height)
+    c_start, c_stop = np.clip(windows[:, 2], 0, width), np.clip(windows[:, 3], 0, width)
+    count = (table[r_stop, c_stop] - table[r_start, c_stop]
+             - table[r_stop, c_start] + table[r_start, c_start])
+    return np.nonzero(count > 0)[0]
+
+
+def geometry_cells(geometry, shape, affine, all_touched=False, bounds=None):
+    """Flat indexes of the cells of the raster grid covered by one geometry,
+    the same cells as io.Raster.read_from_geometry"""
+    height, width = shape
+    window = geometry_window(geometry, affine, bounds)
+    (r_start, r_stop), (c_start, c_stop) = window
+    if r_start >= r_stop or c_start >= c_stop:
+        return np.zeros(0, dtype=_index_dtype(shape))
+    c, _, _, f = window_bounds(window, affine)
+    inside = features.geometry_mask(
+        [geometry], out_shape=(r_stop - r_start, c_stop - c_start),
+        transform=Affine(affine.a, affine.b, c, affine.d, affine.e, f),
+        all_touched=all_touched, invert=True)
+    rows, cols = np.nonzero(inside)
+    rows, cols = rows + r_start, cols + c_start
+    keep = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return (rows[keep].astype(np.int64) * width + cols[keep]).astype(_index_dtype(shape))
+
+
+def rasterize_zones(geometries, shape, affine, all_touched=False, bounds=None):
+    """Rasterize the zones into sparse cell indexes, see Zones.
+        All the zones are burned into one zone id raster, the zones whose window
+        holds a cell covered by more than one geometry are rasterized again one
+        by one, because the zone id raster only keeps the last of them.
+        bounds (numpy array): the io.bounds_array of the geometries, computed
+            when it is not given.
+    """
+    zones = features.rasterize(
+        ((geometry, i) for i, geometry in enumerate(geometries, 1)),
+        out_shape=shape, transform=affine, fill=0,
+        all_touched=all_touched, dtype=np.int32)
+    coverage = features.rasterize(
+        ((geometry, 1) for geometry in geometries),
+        out_shape=shape, transform=affine, fill=0,
+        all_touched=all_touched, dtype=np.int32, merge_alg=MergeAlg.add)
+
+    zones = zones.ravel()
+    cells = np.flatnonzero(zones).astype(_index_dtype(shape))
+    ids = zones[cells]
+
+    overlaps = coverage > 1
+    overlapping = np.zeros(0, dtype=np.int64)
+    if np.any(overlaps):
+        if bounds is None:
+            bounds = bounds_array(geometries)
+        overlapping = overlapping_zones(geometries, overlaps, affine, bounds)
+    overlap_cells = [geometry_cells(geometries[i], shape, affine, all_touched, bounds[i])
+                     for i in overlapping]
+    overlap_offsets = np.zeros(len(overlapping) + 1, dtype=np.int64)
+    overlap_offsets[1:] = np.cumsum([len(c) for c in overlap_cells])
+    overlap_cells = (np.concatenate(overlap_cells) if overlap_cells
+                     else np.zeros(0, dtype=_index_dtype(shape)))
+    return Zones(cells, ids, overlapping, overlap_cells, overlap_offsets)
+
+
+def tile_index(bounds, shape, affine, tile_shape):
+    """Grid index of the zones over the tiles of a raster.
+        The raster is split into tiles of tile_shape cells and every zone is
+        put in all the tiles its window overlaps, so the zones of a tile are
+        found without testing the others.
+        Args:
+            bounds (numpy array): (left, bottom, right, top) of every zone, shape (n, 4).
+            shape (tuple): height and width of the raster.
+            affine (Affine): transform of the raster.
+            tile_shape (tuple): height and width of a tile, e.g. a multiple of
+                the block shape of the raster.
+        Returns:
+            list of (window, zone indexes) of the tiles that hold zones, in row
+            major order, the windows are clipped to the raster.
+    """
+    height, width = shape
+    tile_height, tile_width = tile_shape
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    zones = np.nonzero(np.all(np.isfinite(bounds), axis=1))[0]
+    windows = bounds_windows(bounds[zones], affine)
+    r_start, c_start = np.clip(windows[:, 0], 0, height), np.clip(windows[:, 2], 0, width)
+    r_stop, c_stop = np.clip(windows[:, 1], 0, height), np.clip(windows[:, 3], 0, width)
+    inside = (r_start < r_stop) & (c_start < c_stop)
+    zones, r_start, r_stop = zones[inside], r_start[inside], r_stop[inside]
+    c_start, c_stop = c_start[inside], c_stop[inside]
+
+    # the range of tiles of every zone, expanded to (tile, zone) pairs
+    tr_start, tr_stop = r_start // tile_height, (r_stop - 1) // tile_height + 1
+    tc_start, tc_stop = c_start // tile_width, (c_stop - 1) // tile_width + 1
+    tile_cols = -(-width // tile_width)
+    num_cols = tc_stop - tc_start
+    num_tiles = (tr_stop - tr_start) * num_cols
+    pair_zones = np.repeat(np.arange(len(zones)), num_tiles)
+    k = np.arange(len(pair_zones)) - np.repeat(np.cumsum(num_tiles) - num_tiles, num_tiles)
+    tile_rows = tr_start[pair_zones] + k // num_cols[pair_zones]
+    tile_ids = tile_rows * tile_cols + tc_start[pair_zones] + k % num_cols[pair_zones]
+
+    order = np.argsort(tile_ids, kind='stable')
+    tile_ids, pair_zones = tile_ids[order], zones[pair_zones[order]]
+    ids, starts = np.unique(tile_ids, return_index=True)
+    tiles = []
+    for tile_id, zone_indexes in zip(ids, np.split(pair_zones, starts[1:])):
+        row, col = divmod(int(tile_id), tile_cols)
+        window = ((row * tile_height, min((row + 1) * tile_height, height)),
+                  (col * tile_width, min((col + 1) * tile_width, width)))
+        tiles.append((window, zone_indexes))
+    return tiles
+
+
+def zones_key(geometries, shape, affine, all_touched):
+    """Hash of the content of the zones and of the raster grid they are rasterized on"""
+    sha256 = hashlib.sha256()
+    for geometry in geometries:
+        if isinstance(geometry, bytes):
+            sha256.update(geometry)
+        elif hasattr(geometry, 'wkb'):
+            sha256.update(geometry.wkb)
+        else:
+            geometry = getattr(geometry, '__geo_interface__', geometry)
+            sha256.update(json.dumps(geometry, sort_keys=True).encode('utf-8'))
+        sha256.update(b'\0')
+    sha256.update(json.dumps([list(shape), list(affine)[:6], bool(all_touched)]).encode('utf-8'))
+    return sha256.hexdigest()
+
+
+class ZoneCache:
+    """On-disk cache of rasterized zones, reused across runs and across the
+    population grids (years) that share one raster grid.
+        Every entry is a compressed .npz of the arrays of Zones, named by
+        zones_key: the content of the geometries, the shape and the affine of
+        the grid and all_touched. The least recently used entries are evicted
+        when the cache grows over max_size.
+        Args:
+            cache_dir (string): directory of the cache, defaults to ~/.cache/degurba/zones.
+            max_size (int): maximum size in bytes of the cache.
+    """
+
+    def __init__(self, cache_dir=None, max_size=2 * 2**30):
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # the lock is per process, so the cache can be given to spawned workers
+        return {'cache_dir': self.cache_dir, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                zones = Zones(*(entry[name] for name in (
+                    'cells', 'ids', 'overlapping', 'overlap_cells', 'overlap_offsets')))
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)
+        return zones
+
+    def put(self, key, zones):
+        path = self.path(key)
+        # unique per process and thread, the entry is renamed into place
+        part = '{}.{}.{}.part'.format(path, os.getpid(), threading.get_ident())
+        with open(part, 'wb') as f:
+            np.savez_compressed(f, cells=zones.cells, ids=zones.ids,
+                                overlapping=zones.overlapping,
+                                overlap_cells=zones.overlap_cells,
+                                overlap_offsets=zones.overlap_offsets)
+        os.replace(part, path)
+        self.evict(keep=path)
+
+    def zones(self, geometries, shape, affine, all_touched=False, bounds=None):
+        """Return the Zones of geometries on the grid, from the cache if possible."""
+        key = zones_key(geometries, shape, affine, all_touched)
+        zones = self.get(key)
+        if zones is None:
+            zones = rasterize_zones(geometries, shape, affine, all_touched, bounds)
+            self.put(key, zones)
+        return zones
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    path = os.path.join(self.cache_dir, name)
+                    try:
+                        entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                    except OSError:
+                        continue
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
@@ -0,0 +1,125 @@
+import numpy as np
+from scipy import ndimage
+
+from degurba.cluster import cluster_sums, keep_clusters, majority_fill, majority_label, majority_rule
+
+
+def population(shape, seed=0, masked=True):
+    rng = np.random.default_rng(seed)
+    pn = ndimage.gaussian_filter(rng.random(shape), 2) * 6000
+    pn[rng.random(shape) < 0.1] = 0
+    if masked:
+        pn = np.ma.masked_array(pn, rng.random(shape) < 0.05)
+    return pn
+
+
+def test_cluster_sums_matches_label_loop():
+    pn = population((60, 70))
+    label, num_features = ndimage.label(np.ma.getdata(pn) >= 1500)
+    sums, counts = cluster_sums(label, num_features, pn)
+
+    assert len(sums) == len(counts) == num_features + 1
+    for i in range(1, num_features + 1):
+        cells = pn[label == i]
+        assert counts[i] == cells.count()
+        if cells.count():
+            assert np.isclose(sums[i], np.sum(cells))
+        else:
+            assert sums[i] == 0
+
+
+def test_keep_clusters_matches_label_loop():
+    pn = population((60, 70), seed=1)
+    # a cluster made only of masked cells
+    pn[0:2, 0:2] = np.ma.masked
+    pn.data[0:2, 0:2] = 9000
+    label, num_features = ndimage.label(np.ma.getdata(pn) >= 300)
+    sums, counts = cluster_sums(label, num_features, pn)
+
+    for threshold in (500, 5000, 50000):
+        keep = keep_clusters(sums, counts, threshold)
+        assert not keep[0]
+        for i in range(1, num_features + 1):
+            # the per-cluster loop of the first release, a masked sum is kept
+            assert keep[i] == (not np.sum(pn[label == i]) < threshold)
+
+
+W = np.array(
+    [
+        [1, 1, 1],
+        [1, 0, 1],
+        [1, 1, 1]
+    ]
+)
+
+
+def dense_labels(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = ndimage.gaussian_filter(rng.random(shape), 1.5) > 0.5
+    # gaps inside the clusters
+    mask[rng.random(shape) < 0.15] = False
+    return ndimage.label(mask, structure=[[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+
+
+def reference_fill(mask, label, num_features, max_rounds=None):
+    # every cluster advances from the cells it flipped in the previous round
+    frontiers = [label == i for i in range(1, num_features + 1)]
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        rounds += 1
+        flipped = [np.logical_and(ndimage.convolve(f.astype(np.int8), W, mode='constant') >= 5,
+                                  mask == 0) for f in frontiers]
+        if not np.any(flipped):
+            break
+        for f in flipped:
+            mask[f] = 1
+        frontiers = flipped
+    return mask
+
+
+def test_majority_rule_matches_convolve():
+    label, num_features = dense_labels((50, 60))
+    expected = np.zeros(label.shape, dtype=np.bool_)
+    for i in range(1, num_features + 1):
+        expected |= ndimage.convolve((label == i).astype(np.int8), W, mode='constant') >= 5
+    assert np.array_equal(majority_rule(np.pad(label, 1)), expected)
+    owner = majority_label(np.pad(label, 1))
+    assert np.array_equal(owner > 0, expected)
+    for i in np.unique(owner[owner > 0]):
+        cells = owner == i
+        assert np.all(ndimage.convolve((label == i).astype(np.int8), W, mode='constant')[cells] >= 5)
+
+
+def test_majority_fill_matches_reference():
+    for seed in range(4):
+        label, num_features = dense_labels((50, 60), seed)
+        rng = np.random.default_rng(seed)
+        mask = np.isin(label, rng.choice(num_features, num_features // 2) + 1).astype(np.byte)
+        full = majority_fill(mask.copy(), label)
+        assert np.array_equal(full, reference_fill(mask.copy(), label, num_features))
+        single = majority_fill(mask.copy(), label, max_rounds=1)
+        assert np.array_equal(single, reference_fill(mask.copy(), label, num_features, max_rounds=1))
+        # the later rounds fill the cells opened by the first one
+        assert np.count_nonzero(full) > np.count_nonzero(single)
+
+
+def test_urban_centres_match_baseline():
+    from degurba.main import DEGURBA
+
+    pn = population((60, 70), seed=2) * 4
+    # the first release: per-cluster threshold and convolution loop
+    mask = np.ma.getdata(pn >= 1500).astype(np.byte)
+    label, num_features = ndimage.label(mask, structure=[[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+    for i in range(1, num_features + 1):
+        if np.sum(pn[label == i]) < 50000:
+            mask[label == i] = 0
+    for i in range(1, num_features + 1):
+        frontier = (label == i).astype(np.byte)
+        while True:
+            frontier = ndimage.convolve(frontier, weights=W, mode='constant', cval=0)
+            frontier = np.logical_and(frontier >= 5, mask == 0)
+            if 0 == np.count_nonzero(frontier):
+                break
+            mask[frontier] = 1
+
+    assert np.array_equal(DEGURBA()._get_urban_centres(pn), mask.astype(np.bool_))
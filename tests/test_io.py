@@ -0,0 +1,60 @@
+import pytest
+
+ogr = pytest.importorskip('osgeo.ogr')
+
+from degurba.io import Vector
+
+
+def make_gpkg(path, count=3):
+    driver = ogr.GetDriverByName('GPKG')
+    ds = driver.CreateDataSource(str(path))
+    layer = ds.CreateLayer('units', geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    for i in range(count):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('name', 'unit{}'.format(i))
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(
+            'POLYGON (({0} 0, {1} 0, {1} 1, {0} 1, {0} 0))'.format(i, i + 1)))
+        layer.CreateFeature(feature)
+    ds = None
+    return str(path)
+
+
+def test_write_fields_in_place(tmp_path):
+    path = make_gpkg(tmp_path / 'units.gpkg')
+    Vector(path).write_fields([('cla', 'int', [1, 2, 3]), ('share', 'float', [0.5, None, 1.0])])
+
+    vector = Vector(path)
+    assert vector.columns == ['name', 'cla', 'share']
+    assert vector['cla'] == [1, 2, 3]
+    assert vector['share'] == [0.5, None, 1.0]
+    assert vector['name'] == ['unit0', 'unit1', 'unit2']
+
+
+def test_write_fields_rerun_reuses_field(tmp_path):
+    path = make_gpkg(tmp_path / 'units.gpkg')
+    Vector(path).write_fields([('cla', 'int', [1, 2, 3])])
+    Vector(path).write_fields([('cla', 'int', [3, 2, 1])])
+
+    vector = Vector(path)
+    assert vector.columns == ['name', 'cla']
+    assert vector['cla'] == [3, 2, 1]
+
+
+def test_write_fields_out_path(tmp_path):
+    path = make_gpkg(tmp_path / 'units.gpkg')
+    out = Vector(path).write_fields([('cla', 'int', [1, 2, 3])],
+                                    out_path=str(tmp_path / 'out.gpkg'))
+
+    assert out.columns == ['name', 'cla']
+    assert out['cla'] == [1, 2, 3]
+    assert len(out) == 3
+    assert Vector(path).columns == ['name']
+
+
+def test_write_fields_out_path_is_source(tmp_path):
+    path = make_gpkg(tmp_path / 'units.gpkg')
+    vector = Vector(path)
+    with pytest.raises(ValueError):
+        vector.write_fields([('cla', 'int', [1, 2, 3])], out_path=path)
+    assert len(Vector(path)) == 3
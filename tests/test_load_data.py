@@ -0,0 +1,256 @@
+import os
+import re
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import rasterio as rio
+from affine import Affine
+
+from degurba import load_data
+from degurba.io import Raster
+from degurba.load_data import DownloadCache
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the files of the root of the server with HTTP Range requests"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+        return path if os.path.isfile(path) else None
+
+    def _empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._file()
+        if path is None:
+            return self._empty(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Range')))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            status = server.errors.get(self.path, []).pop(0) if server.errors.get(self.path) else None
+            truncate = server.truncate.pop(self.path, None)
+        try:
+            if server.delay:
+                server.delay_event.wait(server.delay)
+            path = self._file()
+            if status is not None or path is None:
+                return self._empty(status or 404)
+            with open(path, 'rb') as f:
+                data = f.read()
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                start, stop = re.match(r'bytes=(\d+)-(\d*)', byte_range).groups()
+                start = int(start)
+                stop = min(int(stop) if stop else len(data) - 1, len(data) - 1)
+                if start >= len(data):
+                    return self._empty(416)
+                body = data[start:stop + 1]
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stop, len(data)))
+            else:
+                body = data
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if truncate is not None:
+                # a broken connection after truncate bytes of the body
+                body = body[:truncate]
+                self.close_connection = True
+            self.wfile.write(body)
+            with server.lock:
+                server.bytes += len(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A range-capable HTTP server on 127.0.0.1 counting the requests and the bytes sent.
+    The files are written to server.root, server.url(name) is their url."""
+    root = tmp_path / 'www'
+    root.mkdir()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    httpd.root = str(root)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.bytes = 0
+    httpd.active = httpd.max_active = 0
+    # seconds every GET waits, status codes sent before the file and the
+    # number of bytes of the next body sent before the connection breaks
+    httpd.delay = 0
+    httpd.delay_event = threading.Event()
+    httpd.errors = {}
+    httpd.truncate = {}
+    httpd.url = lambda name: 'http://127.0.0.1:{}/{}'.format(httpd.server_port, name)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def serve_file(server, name, size):
+    data = os.urandom(size)
+    with open(os.path.join(server.root, name), 'wb') as f:
+        f.write(data)
+    return server.url(name), data
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_cache_hit(server, tmp_path):
+    url, data = serve_file(server, 'a.tif', 100000)
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    path = cache.fetch(url)
+    assert read(path) == data
+    assert server.bytes == len(data)
+
+    assert cache.fetch(url, sha256=DownloadCache.checksum(path)) == path
+    # another run on the same cache directory
+    assert DownloadCache(str(tmp_path / 'cache')).fetch(url) == path
+    assert len(server.requests) == 1
+    assert server.bytes == len(data)
+
+
+def test_resume_part(server, tmp_path):
+    url, data = serve_file(server, 'a.tif', 100000)
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    # the part of an interrupted download
+    with open(cache.path(url) + '.part', 'wb') as f:
+        f.write(data[:30000])
+    path = cache.fetch(url)
+    assert read(path) == data
+    assert server.requests == [('/a.tif', 'bytes=30000-')]
+    assert server.bytes == len(data) - 30000
+    assert not os.path.exists(cache.path(url) + '.part')
+
+
+def test_checksum_mismatch(server, tmp_path):
+    url, _ = serve_file(server, 'a.tif', 1000)
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    with pytest.raises(ValueError):
+        cache.fetch(url, sha256='0' * 64)
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_eviction_skips_held(server, tmp_path):
+    urls = [serve_file(server, name, 1000)[0] for name in ('a.tif', 'b.tif', 'c.tif', 'd.tif')]
+    cache = DownloadCache(str(tmp_path / 'cache'), max_size=2000)
+    for i, url in enumerate(urls[:2]):
+        os.utime(cache.fetch(url), (1000 + i, 1000 + i))
+
+    # the least recently used entry is held, the next one is evicted instead
+    with cache.hold(urls[0]) as path:
+        os.utime(path, (1000, 1000))
+        cache.fetch(urls[2])
+        assert os.path.exists(path)
+        assert not os.path.exists(cache.path(urls[1]))
+    assert cache._held == {}
+
+    cache.fetch(urls[3])
+    assert sorted(entry[2] for entry in cache.entries()) == \
+        sorted(cache.path(url) for url in urls[2:])
+
+
+
+def test_retry_short_read(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(load_data.time, 'sleep', lambda seconds: None)
+    url, data = serve_file(server, 'a.tif', 100000)
+    server.truncate['/a.tif'] = 40000
+    path = DownloadCache(str(tmp_path / 'cache'), chunk_size=4096).fetch(url)
+    assert read(path) == data
+    # the second attempt resumes after the bytes of the first one
+    assert server.requests == [('/a.tif', None), ('/a.tif', 'bytes=40000-')]
+    assert server.bytes == len(data)
+
+
+def test_retry_transient_errors(server, tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(load_data.time, 'sleep', delays.append)
+    url, data = serve_file(server, 'a.tif', 1000)
+    server.errors['/a.tif'] = [503, 429]
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    assert read(cache.fetch(url)) == data
+    assert len(server.requests) == 3
+    assert delays == [1, 2]
+
+    # the other HTTP errors are final
+    server.errors['/b.tif'] = [403]
+    with pytest.raises(urllib.error.HTTPError):
+        cache.fetch(server.url('b.tif'))
+    with pytest.raises(urllib.error.HTTPError):
+        cache.fetch(server.url('missing.tif'))
+    assert len(server.requests) == 5
+
+    # the server keeps failing
+    server.errors['/a.tif'] = [500] * 3
+    with pytest.raises(urllib.error.HTTPError):
+        DownloadCache(str(tmp_path / 'other'), retries=3).fetch(url)
+    assert len(server.requests) == 8
+
+
+def test_download_many_per_host(server, tmp_path, monkeypatch):
+    countries = ['Benin', 'Togo', 'Ghana', 'Niger', 'Mali', 'Chad']
+    files = {country: serve_file(server, '{}.tif'.format(country), 5000)[1]
+             for country in countries[:-1]}
+    monkeypatch.setattr(load_data, 'find_url',
+                        lambda dataset, year, country: server.url('{}.tif'.format(country)))
+    server.delay = 0.2
+    manifest = load_data.Dataset(str(tmp_path / 'cache')).download_many(
+        'worldPop_adjusted_1km', [2020], countries, out_dir=str(tmp_path / 'out'),
+        workers=6, per_host=2)
+    # at most 2 connections to the host at a time
+    assert server.max_active == 2
+    assert [entry['country'] for entry in manifest] == countries
+    for entry in manifest[:-1]:
+        assert entry['error'] is None
+        assert read(entry['path']) == files[entry['country']]
+    # a missing file does not stop the others
+    assert manifest[-1]['path'] is None
+    assert isinstance(manifest[-1]['error'], urllib.error.HTTPError)
+
+
+def test_vsicurl_window(server):
+    path = os.path.join(server.root, 'pn.tif')
+    array = np.arange(512 * 512, dtype=np.float32).reshape(512, 512)
+    with rio.open(path, 'w', driver='GTiff', height=512, width=512, count=1,
+                  dtype='float32', crs='EPSG:3857', transform=Affine(100, 0, 0, 0, -100, 0),
+                  tiled=True, blockxsize=64, blockysize=64) as dst:
+        dst.write(array, 1)
+
+    raster = Raster(server.url('pn.tif'))
+    assert raster.lazy
+    window = ((100, 150), (300, 420))
+    clipped = raster.read(window=window)
+    assert np.array_equal(clipped.array, array[100:150, 300:420])
+    assert clipped.affine == Affine(100, 0, 30000, 0, -100, -10000)
+    raster.close()
+    # the header and the blocks of the window are read by range requests
+    assert server.requests
+    assert all(byte_range is not None for _, byte_range in server.requests)
+    assert server.bytes < os.path.getsize(path) / 4
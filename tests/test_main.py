@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from affine import Affine
+from scipy import ndimage
+
+from degurba.main import DEGURBA
+
+AFFINE = Affine(1000, 0, 0, 0, -1000, 0)
+
+
+def population(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    field = ndimage.gaussian_filter(rng.random(shape), 2.5)
+    field = (field - field.min()) / (field.max() - field.min())
+    pn = field ** 3 * 12000 * (rng.random(shape) > 0.1)
+    return np.ma.masked_array(pn, rng.random(shape) < 0.02)
+
+
+def reference_l2(pn, l1):
+    # the level 2 rules cluster by cluster
+    data = np.ma.getdata(pn)
+    centres = l1 == 1
+    dense, num_dense = ndimage.label(data >= 1500, structure=[[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+    dense_urban = np.zeros(pn.shape, dtype=np.bool_)
+    for i in range(1, num_dense + 1):
+        if not np.sum(pn[dense == i]) < 5000:
+            dense_urban |= dense == i
+    dense_urban &= ~centres
+    moderate, num_moderate = ndimage.label(data >= 300, structure=np.ones((3, 3)))
+    near = ndimage.binary_dilation(centres | dense_urban, structure=np.ones((3, 3)), iterations=2)
+    remaining = (l1 == 2) & ~dense_urban
+    l2 = np.zeros(pn.shape, dtype=np.int8)
+    l2[l1 == 3] = np.where(data >= 50, 32, 33)[l1 == 3]
+    for i in range(1, num_moderate + 1):
+        cluster = moderate == i
+        total = np.sum(pn[cluster])
+        if 500 <= total < 5000:
+            l2[cluster & (l1 == 3)] = 31
+        l2[cluster & remaining] = 23 if np.any(near[cluster]) else 22
+    l2[dense_urban] = 21
+    l2[centres] = 11
+    return l2
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_level2_matches_cluster_rules(seed):
+    pn = population((80, 90), seed)
+    degurba = DEGURBA(pn, affine=AFFINE, crs='EPSG:3857')
+    l1, l2 = degurba.classify_grid_cells()
+    l1, l2 = l1.array.filled(0), l2.array.filled(0)
+    assert np.array_equal(l1, degurba.classify_grid_cells_l1().array.filled(0))
+    assert np.array_equal(l2, degurba.classify_grid_cells_l2().array.filled(0))
+    assert np.array_equal(l2, reference_l2(pn, l1))
+    # every level 2 class refines its level 1 class
+    assert np.array_equal(l2 // 10, l1)
+
+
+def test_level2_classes_present():
+    pn = np.full((40, 60), 100.)
+    # an urban centre
+    pn[2:12, 2:12] = 2000
+    # a dense urban cluster in a suburban ring, a line the majority rule
+    # does not fill
+    pn[27:32, 1:12] = 400
+    pn[29, 2:11] = 2000
+    # a semi-dense urban cluster
+    pn[20:24, 40:44] = 400
+    # a rural cluster
+    pn[33:35, 50:52] = 400
+    # very low density rural grid cells
+    pn[36:40, 20:30] = 10
+    l2 = DEGURBA(pn, affine=AFFINE, crs='EPSG:3857').classify_grid_cells_l2().array.filled(0)
+    assert np.array_equal(np.unique(l2), sorted(DEGURBA.grid_cells_l2_cla.values()))
+    assert l2[5, 5] == 11 and l2[29, 4] == 21 and l2[27, 1] == 23
+    assert l2[21, 41] == 22 and l2[33, 50] == 31 and l2[0, 59] == 32 and l2[37, 25] == 33
+
+
+def test_level2_tiled_mode_raises(tmp_path):
+    degurba = DEGURBA(str(tmp_path / 'pn.tif'), max_memory=2**20)
+    with pytest.raises(ValueError):
+        degurba.classify_grid_cells_l2()
+    with pytest.raises(ValueError):
+        degurba.classify_grid_cells()
+
+
+@pytest.mark.parametrize('workers', [2, 3, 30, None])
+def test_classify_grid_cells_workers(workers):
+    pn = population((90, 70), seed=4)
+    serial = DEGURBA(pn, affine=AFFINE, crs='EPSG:3857')
+    expected = [raster.array for raster in serial.classify_grid_cells()]
+    degurba = DEGURBA(pn, affine=AFFINE, crs='EPSG:3857', workers=workers)
+    # a few rows per band, the clusters and the 2-cell distances cross the seams
+    for raster, array in zip(degurba.classify_grid_cells(), expected):
+        assert np.array_equal(raster.array.filled(0), array.filled(0))
+    assert np.array_equal(degurba.classify_grid_cells_l1().array.filled(0), expected[0].filled(0))
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from affine import Affine
+from scipy import ndimage
+
+from degurba import tiled
+from degurba.main import DEGURBA
+
+
+def write_population(path, shape, seed=0, nodata=-99999):
+    rng = np.random.default_rng(seed)
+    field = ndimage.gaussian_filter(rng.random(shape), 3)
+    field = (field - field.min()) / (field.max() - field.min())
+    pn = (field ** 2 * 9000 * (rng.random(shape) > 0.1)).astype(np.float32)
+    pn[rng.random(shape) < 0.02] = nodata
+    with rio.open(path, 'w', driver='GTiff', height=shape[0], width=shape[1], count=1,
+                  dtype='float32', nodata=nodata, crs='EPSG:3857',
+                  transform=Affine(1000, 0, 0, 0, -1000, 0)) as dst:
+        dst.write(pn, 1)
+    return str(path)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('rows', [1, 3, 17])
+def test_tiled_l1_matches_in_memory(tmp_path, seed, rows):
+    path = write_population(tmp_path / 'pn.tif', (120, 90), seed)
+    expected = DEGURBA(path).classify_grid_cells_l1().array.filled(0)
+    classes = DEGURBA.grid_cells_l1_cla
+    # the clusters and the gaps filled by the majority rule cross the seams
+    assert np.count_nonzero(expected == classes['urban_centres'])
+    assert np.count_nonzero(expected == classes['urban_clusters'])
+
+    max_memory = 90 * tiled.BYTES_PER_CELL * rows
+    out_path = str(tmp_path / 'out.tif')
+    assert DEGURBA(path, max_memory=max_memory).classify_grid_cells_l1(out_path) == out_path
+    with rio.open(out_path) as src:
+        assert src.nodata == 0
+        assert np.array_equal(src.read(1), expected)
+
+
+def test_row_windows():
+    windows = tiled.row_windows(10, 4, 4 * tiled.BYTES_PER_CELL * 3)
+    assert [(w.row_off, w.height) for w in windows] == [(0, 3), (3, 3), (6, 3), (9, 1)]
+    with pytest.raises(ValueError):
+        tiled.row_windows(10, 4, 4 * tiled.BYTES_PER_CELL - 1)
+
+
+def test_merge_labels():
+    upper = np.array([1, 1, 0, 2, 0])
+    lower = np.array([0, 3, 0, 0, 4])
+    assert np.array_equal(tiled.seam_pairs(upper, lower), [[1, 3]])
+    assert np.array_equal(tiled.seam_pairs(upper, lower, diagonal=True), [[1, 3], [2, 4]])
+    roots = tiled.merge_labels(4, [tiled.seam_pairs(upper, lower, diagonal=True)])
+    assert roots[0] == 0
+    assert roots[1] == roots[3] and roots[2] == roots[4] and roots[1] != roots[2]
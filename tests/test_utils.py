@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from affine import Affine
+from scipy import ndimage
+
+from degurba.io import Raster
+from degurba.main import DEGURBA
+from degurba.utils import center_values, zonal_counts, zonal_stats
+
+N = 60
+AFFINE = Affine(1000, 0, 0, 0, -1000, N * 1000)
+CATEGORIES = [1, 2, 3]
+
+
+def grid_cells(seed=0):
+    rng = np.random.default_rng(seed)
+    # regions of one class with scattered masked cells
+    field = ndimage.gaussian_filter(rng.random((N, N)), 5)
+    classes = np.digitize(field, np.quantile(field, [0.3, 0.6])).astype(np.int8) + 1
+    classes[rng.random((N, N)) < 0.05] = 0
+    return Raster(classes, affine=AFFINE, crs='EPSG:3857', nodata=0)
+
+
+def polygon(x, y, width, height):
+    return {'type': 'Polygon',
+            'coordinates': [[(x, y), (x + width, y), (x + width, y + height),
+                             (x, y + height), (x, y)]]}
+
+
+def local_units(seed=0):
+    rng = np.random.default_rng(seed)
+    # a tiling off the cell edges
+    geometries = [polygon(i * 6000 + 3.3, j * 6000 + 7.1, 6000, 6000)
+                  for i in range(10) for j in range(10)]
+    # overlapping zones, some of them across the edge of the raster
+    for _ in range(15):
+        x, y = rng.uniform(-5000, N * 1000, 2)
+        geometries.append(polygon(x, y, rng.uniform(2000, 15000), rng.uniform(2000, 15000)))
+    geometries.append({'type': 'MultiPolygon', 'coordinates': [
+        polygon(20000, 20000, 3000, 5000)['coordinates'],
+        polygon(45000, 4000, 4000, 2500)['coordinates']]})
+    # zones that do not cover any cell center, and one out of the raster
+    geometries += [polygon(12100, 30100, 300, 200), polygon(40700, 8800, 100, 100),
+                   polygon(-9000, -9000, 500, 500)]
+    return geometries
+
+
+def reference_counts(geometries, raster, all_touched):
+    counts, total = [], []
+    for geometry in geometries:
+        array = raster.read_from_geometry([geometry], all_touched=all_touched).array
+        counts.append([np.count_nonzero((array == value).filled(False))
+                       for value in CATEGORIES])
+        total.append(array.count())
+    return np.array(counts), np.array(total)
+
+
+@pytest.mark.parametrize('all_touched', [False, True])
+def test_zonal_counts_matches_read_from_geometry(all_touched):
+    raster, geometries = grid_cells(), local_units()
+    counts, total = zonal_counts(geometries, raster, CATEGORIES, all_touched=all_touched)
+    expected_counts, expected_total = reference_counts(geometries, raster, all_touched)
+    assert np.array_equal(counts, expected_counts)
+    assert np.array_equal(total, expected_total)
+
+
+def test_zonal_counts_weights():
+    raster, geometries = grid_cells(), local_units()
+    rng = np.random.default_rng(1)
+    weights = Raster(np.ma.masked_array(rng.random((N, N)) * 100, rng.random((N, N)) < 0.1),
+                     affine=AFFINE, crs='EPSG:3857')
+    counts, total, sums, sums_total = zonal_counts(geometries, raster, CATEGORIES,
+                                                   weights=weights)
+    expected_counts, expected_total = zonal_counts(geometries, raster, CATEGORIES)
+    assert np.array_equal(counts, expected_counts)
+    assert np.array_equal(total, expected_total)
+    for i, geometry in enumerate(geometries):
+        array = raster.read_from_geometry([geometry]).array
+        cells = weights.read_from_geometry([geometry]).array.filled(0)
+        expected = [cells[(array == value).filled(False)].sum() for value in CATEGORIES]
+        assert np.allclose(sums[i], expected)
+        assert np.isclose(sums_total[i], cells[~np.ma.getmaskarray(array)].sum())
+
+
+@pytest.mark.parametrize('all_touched', [False, True])
+def test_local_units_rasterize_matches_per_zone(all_touched):
+    raster, geometries = grid_cells(), local_units()
+    degurba = DEGURBA()
+    rasterized = degurba.classify_local_units_l1(geometries, grid_cells_l1=raster,
+                                                 all_touched=all_touched)
+    per_zone = degurba.classify_local_units_l1(geometries, grid_cells_l1=raster,
+                                               all_touched=all_touched, rasterize=False)
+    assert np.array_equal(rasterized, per_zone)
+    assert set(rasterized[:100]) == set(DEGURBA.local_units_l1_cla.values())
+
+
+@pytest.mark.parametrize('all_touched', [False, True])
+def test_zonal_counts_workers(all_touched):
+    raster, geometries = grid_cells(), local_units()
+    expected = zonal_counts(geometries, raster, CATEGORIES, all_touched=all_touched,
+                            weights=raster)
+    results = zonal_counts(geometries, raster, CATEGORIES, all_touched=all_touched,
+                           weights=raster, workers=3)
+    for result, expected_result in zip(results, expected):
+        assert np.array_equal(result, expected_result)
+
+
+def test_zonal_stats_workers():
+    raster, geometries = grid_cells(), local_units()
+    stats = ['mean', 'count', 'median']
+    assert zonal_stats(geometries, raster, None, stat=stats, workers=2) == \
+        zonal_stats(geometries, raster, None, stat=stats)
+    degurba = DEGURBA()
+    assert np.array_equal(
+        degurba.classify_local_units_l1(geometries, grid_cells_l1=raster,
+                                        rasterize=False, workers=2),
+        degurba.classify_local_units_l1(geometries, grid_cells_l1=raster, rasterize=False))
+
+
+def write_raster(path, raster, blocksize=16):
+    with rio.open(path, 'w', driver='GTiff', height=N, width=N, count=1,
+                  dtype=raster.array.dtype, nodata=0, crs='EPSG:3857', transform=AFFINE,
+                  tiled=True, blockxsize=blocksize, blockysize=blocksize) as dst:
+        dst.write(raster.array.filled(0), 1)
+    return str(path)
+
+
+def test_center_values(tmp_path):
+    raster = grid_cells()
+    rows = np.array([0, 5, 59, 30, -1, 60, 10, 10])
+    cols = np.array([0, 40, 59, 30, 10, 10, -1, 60])
+    x, y = (cols + 0.5) * 1000, N * 1000 - (rows + 0.5) * 1000
+    bounds = np.column_stack([x - 200, y - 100, x + 200, y + 100])
+    inside = (rows >= 0) & (rows < N) & (cols >= 0) & (cols < N)
+    classes = raster.array.filled(0)
+    lazy = Raster(write_raster(tmp_path / 'grid_cells.tif', raster), lazy=True)
+    for values in (center_values(raster, bounds), center_values(lazy, bounds)):
+        # out of the raster or on a masked cell
+        assert np.array_equal(values.mask, ~inside | (classes[rows % N, cols % N] == 0))
+        assert np.array_equal(values.filled(0)[inside], classes[rows[inside], cols[inside]])
+
+
+def test_local_units_sub_pixel():
+    raster = grid_cells()
+    classes = raster.array.filled(0)
+    rng = np.random.default_rng(2)
+    x, y = rng.uniform(-5000, (N + 5) * 1000, (2, 300))
+    geometries = [polygon(x0, y0, 100, 100) for x0, y0 in zip(x, y)]
+    rows, cols = np.floor(N - (y + 50) / 1000).astype(int), np.floor((x + 50) / 1000).astype(int)
+    inside = (rows >= 0) & (rows < N) & (cols >= 0) & (cols < N)
+    expected = np.zeros(len(geometries), dtype=np.int64)
+    expected[inside] = classes[rows[inside], cols[inside]]
+    assert np.count_nonzero(expected == 0) > np.count_nonzero(~inside)
+
+    degurba = DEGURBA()
+    for rasterize in (True, False):
+        values = degurba.classify_local_units_l1(geometries, grid_cells_l1=raster,
+                                                 rasterize=rasterize)
+        # class 0 for the local units out of the raster or on a masked cell
+        assert np.array_equal(values, expected)
+
+
+@pytest.mark.parametrize('size', [16, 32, 1024])
+def test_zonal_counts_lazy(tmp_path, size, monkeypatch):
+    raster, geometries = grid_cells(), local_units()
+    lazy = Raster(write_raster(tmp_path / 'grid_cells.tif', raster), lazy=True)
+    # tiles of size cells, the zones span several of them
+    tile_shape = lazy.tile_shape
+    monkeypatch.setattr(lazy, 'tile_shape', lambda size=size: tile_shape(size))
+    for all_touched in (False, True):
+        expected = zonal_counts(geometries, raster, CATEGORIES, all_touched=all_touched,
+                                weights=raster)
+        results = zonal_counts(geometries, lazy, CATEGORIES, all_touched=all_touched,
+                               weights=Raster(lazy))
+        assert np.array_equal(results[0], expected[0])
+        assert np.array_equal(results[1], expected[1])
+        assert np.allclose(results[2], expected[2])
+        assert np.allclose(results[3], expected[3])
+    stats = ['mean', 'count']
+    assert zonal_stats(geometries, lazy, None, stat=stats) == \
+        zonal_stats(geometries, raster, None, stat=stats)
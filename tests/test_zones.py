@@ -0,0 +1,91 @@
+import os
+import numpy as np
+from affine import Affine
+
+from degurba import zones
+from degurba.io import bounds_array
+from degurba.zones import ZoneCache, rasterize_zones, zones_key
+
+SHAPE = (40, 50)
+AFFINE = Affine(1000, 0, 0, 0, -1000, 40000)
+
+
+def polygon(x, y, width, height):
+    return {'type': 'Polygon',
+            'coordinates': [[(x, y), (x + width, y), (x + width, y + height),
+                             (x, y + height), (x, y)]]}
+
+
+GEOMETRIES = [polygon(1000, 1000, 9000, 7000), polygon(8000, 5000, 12000, 9000),
+              polygon(30000, 20000, 15000, 15000)]
+
+
+def assert_zones_equal(a, b):
+    for name in ('cells', 'ids', 'overlapping', 'overlap_cells', 'overlap_offsets'):
+        assert np.array_equal(getattr(a, name), getattr(b, name))
+
+
+def test_zone_cache_hit(tmp_path, monkeypatch):
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return rasterize_zones(*args, **kwargs)
+
+    monkeypatch.setattr(zones, 'rasterize_zones', counted)
+    cache = ZoneCache(str(tmp_path))
+    first = cache.zones(GEOMETRIES, SHAPE, AFFINE)
+    assert len(calls) == 1
+    # another run, e.g. the grid of another year
+    second = ZoneCache(str(tmp_path)).zones(GEOMETRIES, SHAPE, AFFINE)
+    assert len(calls) == 1
+    assert_zones_equal(first, second)
+    assert_zones_equal(first, rasterize_zones(GEOMETRIES, SHAPE, AFFINE))
+    assert len(first.overlapping) == 2
+
+    # the key depends on the geometries, the grid and all_touched
+    cache.zones(GEOMETRIES, SHAPE, AFFINE, all_touched=True)
+    cache.zones(GEOMETRIES[:2], SHAPE, AFFINE)
+    cache.zones(GEOMETRIES, SHAPE, AFFINE * Affine.translation(1, 0))
+    assert len(calls) == 4
+    assert len(os.listdir(str(tmp_path))) == 4
+
+
+def test_zone_cache_eviction(tmp_path):
+    cache = ZoneCache(str(tmp_path))
+    keys = []
+    for i, geometry in enumerate(GEOMETRIES):
+        keys.append(zones_key([geometry], SHAPE, AFFINE, False))
+        cache.put(keys[-1], rasterize_zones([geometry], SHAPE, AFFINE))
+        os.utime(cache.path(keys[-1]), (1000 + i, 1000 + i))
+    sizes = [os.path.getsize(cache.path(key)) for key in keys]
+
+    # reading an entry makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    cache.max_size = sizes[0] + sizes[2]
+    cache.evict()
+    assert not os.path.exists(cache.path(keys[1]))
+    assert os.path.exists(cache.path(keys[0])) and os.path.exists(cache.path(keys[2]))
+
+    # the entry just written is kept even if it does not fit alone
+    cache.max_size = 0
+    cache.evict(keep=cache.path(keys[2]))
+    assert os.listdir(str(tmp_path)) == [os.path.basename(cache.path(keys[2]))]
+    assert cache.get(keys[0]) is None
+
+
+def test_tile_index():
+    # a zone out of the raster and one without bounds
+    bounds = np.vstack([bounds_array(GEOMETRIES), [60000, 0, 70000, 5000], [np.nan] * 4])
+    tiles = zones.tile_index(bounds, SHAPE, AFFINE, (16, 16))
+    windows = [window for window, _ in tiles]
+    assert windows == sorted(windows)
+    for window, indexes in tiles:
+        (r_start, r_stop), (c_start, c_stop) = window
+        assert r_stop - r_start <= 16 and c_stop - c_start <= 16
+        assert r_stop <= SHAPE[0] and c_stop <= SHAPE[1]
+    counts = np.bincount(np.concatenate([indexes for _, indexes in tiles]), minlength=len(bounds))
+    # rows 32 to 39 and columns 1 to 9 are in one tile, rows 26 to 34 and
+    # columns 8 to 19 in four, rows 5 to 19 and columns 30 to 44 in four
+    assert list(counts) == [1, 4, 4, 0, 0]
+    assert len(tiles) == 7